@@ -1,18 +1,48 @@
 import logging
 import asyncio
+import bisect
+import contextvars
+import contextlib
+import csv
+import cProfile
+import hashlib
+import heapq
+import html
 import io
+import itertools
+import json
 import os
+import pstats
+import random
+import re
+import secrets
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta
+from urllib.parse import quote
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 import qrcode
+from PIL import Image
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,23 +51,551 @@ load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URL = os.getenv("MONGO_URL")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+# full admins; ADMIN_ID alone keeps working as before
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", str(ADMIN_ID)).split(",") if x.strip()]
+# who gets proofs / help requests, in round-robin order
+REVIEWER_IDS = [int(x) for x in os.getenv("REVIEWER_IDS", ",".join(map(str, ADMIN_IDS))).split(",") if x.strip()]
+ASSIGN_STRATEGY = os.getenv("ASSIGN_STRATEGY", "least_loaded")  # least_loaded | round_robin
+REVIEWER_STATS_DAYS = int(os.getenv("REVIEWER_STATS_DAYS", 7))
+RECONCILE_TOKEN = os.getenv("RECONCILE_TOKEN")  # POST /reconcile is off without it
+RECONCILE_WINDOW_HOURS = int(os.getenv("RECONCILE_WINDOW_HOURS", 72))  # payment vs order time
+RECONCILE_LOOKBACK_DAYS = int(os.getenv("RECONCILE_LOOKBACK_DAYS", 30))
+UPI_AMOUNT_TAGS = int(os.getenv("UPI_AMOUNT_TAGS", 0))  # >0: add up to this many paise per checkout, shown to the user
+RECONCILE_SUGGESTIONS = int(os.getenv("RECONCILE_SUGGESTIONS", 20))  # amount matches offered for one-tap approval
+PROOF_HASH_BANDS = int(os.getenv("PROOF_HASH_BANDS", 17))  # near-duplicates up to BANDS-1 bits apart are always found
+PROOF_HASH_DISTANCE = int(os.getenv("PROOF_HASH_DISTANCE", 16))  # out of 256 bits
+PROOF_HASH_CANDIDATES = int(os.getenv("PROOF_HASH_CANDIDATES", 50))  # newest proofs compared per band
 PORT = int(os.getenv("PORT", 8080))
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")   # public base url, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# same on every replica by default, Telegram sends it back in a header
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256((TOKEN or "").encode()).hexdigest()[:32]
 ADMIN_UPI = os.getenv("ADMIN_UPI", "yourname@upi")
 WELCOME_IMAGE = os.getenv("WELCOME_IMAGE", "https://files.catbox.moe/17kvug.jpg")
 BOT_PASSCODE = os.getenv("BOT_PASSCODE", "1234")
+FSM_STORAGE = os.getenv("FSM_STORAGE", "mongo")  # mongo | redis | memory
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FSM_TTL = int(os.getenv("FSM_TTL", 86400))
+QUERY_AUDIT = os.getenv("QUERY_AUDIT", "0") == "1"
+SETTINGS_POLL_INTERVAL = int(os.getenv("SETTINGS_POLL_INTERVAL", 30))
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", 256))
+VERIFIED_CACHE_SIZE = int(os.getenv("VERIFIED_CACHE_SIZE", 50000))
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 1000))
+VERIFIED_CACHE_TTL = int(os.getenv("VERIFIED_CACHE_TTL", 6 * 3600))
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", 20))
+USERS_MATCH_COUNT_CAP = int(os.getenv("USERS_MATCH_COUNT_CAP", 1000))  # search results counted up to this
+QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", 8))
+APPROVE_CONCURRENCY = int(os.getenv("APPROVE_CONCURRENCY", 5))
+ORDER_CLAIM_TIMEOUT = int(os.getenv("ORDER_CLAIM_TIMEOUT", 300))  # stuck "approving" → claimable again
+USERS_COUNT_TTL = int(os.getenv("USERS_COUNT_TTL", 60))
+JOB_HEAP_SIZE = int(os.getenv("JOB_HEAP_SIZE", 100))
+SUB_HISTORY_SIZE = int(os.getenv("SUB_HISTORY_SIZE", 24))  # past periods kept per subscription
+JOB_MAX_SLEEP = int(os.getenv("JOB_MAX_SLEEP", 60))
+JOB_LEASE = int(os.getenv("JOB_LEASE", 300))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_BASE = int(os.getenv("JOB_RETRY_BASE", 30))
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 10))
+BULK_WRITE_SIZE = int(os.getenv("BULK_WRITE_SIZE", 200))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 200))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 30))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", 5))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", 120))
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+UPI_PAYEE_NAME = os.getenv("UPI_PAYEE_NAME", "VIP Membership")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # optional bearer token for /metrics
+METRICS_FSM_INTERVAL = int(os.getenv("METRICS_FSM_INTERVAL", 60))  # seconds between FSM state counts
+PROFILE_SLOW_MS = int(os.getenv("PROFILE_SLOW_MS", 0))  # 0 = profiling off
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.05))
+SLOW_LOG_SIZE = int(os.getenv("SLOW_LOG_SIZE", 50))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+LOOP_LAG_READY_MS = int(os.getenv("LOOP_LAG_READY_MS", 500))  # /ready fails above this
+SLOW_CALLBACK_MS = int(os.getenv("SLOW_CALLBACK_MS", 0))  # >0 turns on asyncio debug mode
+UPDATE_ORDERING = os.getenv("UPDATE_ORDERING", "1") == "1"  # serialize updates per user
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))  # 0 = no global cap
 
 logging.basicConfig(level=logging.INFO)
 
+# ================= METRICS =================
+# Minimal Prometheus text-format metrics. Every label is drawn from a small,
+# fixed set (handler names, collections, API methods), so a series is created
+# once and each observation is a lock + a couple of additions. pymongo
+# reports from its own threads, hence the lock.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for labels, v in list(self.values.items()):
+            out.append(f"{self.name}{format_labels(self.labels, labels)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in list(self.series.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets + ("+Inf",), counts):
+                cumulative += c
+                le = format_labels(self.labels + ("le",), labels + (bound,))
+                out.append(f"{self.name}_bucket{le} {cumulative}")
+            out.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            out.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return out
+
+def gauge(name, doc, values, labels=(), kind="gauge"):
+    # values: {label tuple: number}, computed at scrape time
+    out = [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+    for label_values, v in values.items():
+        out.append(f"{name}{format_labels(labels, label_values)} {v}")
+    return out
+
+updates_total = Counter("bot_updates_total", "Handled updates", ("handler", "outcome"))
+handler_seconds = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+mongo_seconds = Histogram("bot_mongo_seconds", "Mongo command latency", ("collection", "command"))
+mongo_errors = Counter("bot_mongo_errors_total", "Failed Mongo commands", ("collection", "command"))
+telegram_seconds = Histogram("bot_telegram_seconds", "Bot API call latency", ("method",))
+telegram_errors = Counter("bot_telegram_errors_total", "Failed Bot API calls", ("method",))
+scheduler_pass_seconds = Histogram(
+    "bot_scheduler_pass_seconds", "Scheduler pass duration",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+)
+update_wait_seconds = Histogram(
+    "bot_update_wait_seconds", "Time an update waited for its user slot and a global slot"
+)
+update_key_depth = Histogram(
+    "bot_update_key_depth", "Updates queued for the same user when one arrives",
+    buckets=(1, 2, 3, 5, 10, 20, 50)
+)
+loop_lag_seconds = Histogram(
+    "bot_loop_lag_seconds", "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+# per-update I/O time accumulator, only set while profiling an update.
+# Motor copies the context into its executor threads, so the command
+# listener sees the same dict.
+io_timings = contextvars.ContextVar("io_timings", default=None)
+
+def add_io_time(kind, seconds):
+    acc = io_timings.get()
+    if acc is not None:
+        acc[kind] += seconds
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self.inflight = {}
+
+    def labels(self, event):
+        return self.inflight.pop((event.connection_id, event.request_id), ("-", event.command_name))
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        collection = target if isinstance(target, str) else "-"
+        self.inflight[(event.connection_id, event.request_id)] = (collection, event.command_name)
+
+    def succeeded(self, event):
+        mongo_seconds.observe(event.duration_micros / 1e6, *self.labels(event))
+        add_io_time("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = self.labels(event)
+        mongo_seconds.observe(event.duration_micros / 1e6, *labels)
+        mongo_errors.inc(*labels)
+        add_io_time("mongo", event.duration_micros / 1e6)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(event, data)
+        except SkipHandler:
+            outcome = "skipped"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+            updates_total.inc(name, outcome)
+
+# ================= PROFILING =================
+# Opt-in (PROFILE_SLOW_MS > 0): updates slower than the threshold land in a
+# ring buffer with their Mongo / Telegram / rate-limit wait / other split.
+# A PROFILE_SAMPLE_RATE share of updates also runs under cProfile and keeps
+# its top functions if slow. cProfile records the whole thread, so while the
+# handler awaits it would also record every other task: a sampled update
+# waits until no other handler is running and holds new ones back until it
+# is done. Background tasks (scheduler, broadcasts, send queue) can still
+# show up in its profile. Sampling slows the bot down, keep the rate low.
+slow_updates = deque(maxlen=SLOW_LOG_SIZE)
+
+class ProfileGate:
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.running = 0
+        self.exclusive = False  # a profiled handler runs or waits to
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.exclusive)
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def alone(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.exclusive)
+            # block new handlers first, then wait for the running ones
+            self.exclusive = True
+            await self.cond.wait_for(lambda: self.running == 0)
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.exclusive = False
+                self.cond.notify_all()
+
+profile_gate = ProfileGate()
+
+class ProfilingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        profiled = random.random() < PROFILE_SAMPLE_RATE
+        async with profile_gate.alone() if profiled else profile_gate.shared():
+            acc = {"mongo": 0.0, "telegram": 0.0, "queue": 0.0}
+            token = io_timings.set(acc)
+
+            profiler = None
+            if profiled:
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                total = time.perf_counter() - started
+                io_timings.reset(token)
+                if profiler:
+                    profiler.disable()
+
+                if total * 1000 >= PROFILE_SLOW_MS:
+                    record_slow_update(data, event, total, acc, profiler)
+
+def record_slow_update(data, event, total, acc, profiler):
+    stack = None
+    if profiler:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        stack = out.getvalue()
+
+    user = data.get("event_from_user")
+    slow_updates.append({
+        "at": datetime.utcnow().isoformat(timespec="seconds"),
+        "handler": data["handler"].callback.__name__,
+        "event": type(event).__name__,
+        "user_id": user.id if user else None,
+        "total_ms": round(total * 1000, 1),
+        "mongo_ms": round(acc["mongo"] * 1000, 1),
+        "telegram_ms": round(acc["telegram"] * 1000, 1),
+        "queue_ms": round(acc["queue"] * 1000, 1),
+        "other_ms": round(max(total - sum(acc.values()), 0) * 1000, 1),
+        "profile": stack
+    })
+    logging.warning(
+        "Slow update: %s took %.0f ms", data["handler"].callback.__name__, total * 1000
+    )
+
+# ================= UPDATE ORDERING =================
+# Updates are handled as concurrent tasks (polling and webhook alike).
+# UpdateOrdering keeps one user's updates strictly in arrival order
+# (select_plan → proceed_payment → receive_proof) while other users run in
+# parallel, up to UPDATE_CONCURRENCY handlers at once. It is passed to the
+# Dispatcher as events_isolation, so aiogram's FSMContextMiddleware takes the
+# user's lock before it reads the FSM state: the next update only sees the
+# state once the previous one has finished and saved it. The locks live in
+# this process; several webhook replicas behind a load balancer are not
+# ordered against each other.
+class UpdateOrdering(BaseEventIsolation):
+    def __init__(self, limit):
+        self.keys = {}  # key -> [lock, queued]
+        self.semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.stats = {"active": 0, "waiting": 0, "max_depth": 0}
+
+    def slot(self):
+        return self.semaphore or contextlib.nullcontext()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        key = ("user", key.user_id)
+        entry = self.keys.get(key)
+        if entry is None:
+            entry = self.keys[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        update_key_depth.observe(entry[1])
+        self.stats["max_depth"] = max(self.stats["max_depth"], entry[1])
+
+        self.stats["waiting"] += 1
+        waiting = True
+        started = time.perf_counter()
+        try:
+            # asyncio.Lock wakes waiters FIFO, so arrival order is kept
+            async with entry[0]:
+                async with self.slot():
+                    self.stats["waiting"] -= 1
+                    waiting = False
+                    update_wait_seconds.observe(time.perf_counter() - started)
+                    self.stats["active"] += 1
+                    try:
+                        yield
+                    finally:
+                        self.stats["active"] -= 1
+        finally:
+            if waiting:
+                self.stats["waiting"] -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.keys[key]
+
+    async def close(self):
+        pass
+
+    def top_keys(self, n=5):
+        busy = sorted(self.keys.items(), key=lambda kv: kv[1][1], reverse=True)
+        return [(k, e[1]) for k, e in busy[:n] if e[1] > 1]
+
+class UnkeyedUpdateLimit(BaseMiddleware):
+    # updates without a user or chat get no FSM context and so never reach
+    # UpdateOrdering.lock(); they still count against the global cap
+    def __init__(self, ordering):
+        self.ordering = ordering
+
+    async def __call__(self, handler, event, data):
+        if data.get("event_from_user") or data.get("event_chat"):
+            return await handler(event, data)
+        async with self.ordering.slot():
+            return await handler(event, data)
+
+update_ordering = UpdateOrdering(UPDATE_CONCURRENCY)
+
 # ================= DATABASE =================
-cluster = AsyncIOMotorClient(MONGO_URL)
+cluster = AsyncIOMotorClient(MONGO_URL, event_listeners=[MongoCommandMetrics()])
 db = cluster["VipBotDB"]
 settings_col = db["settings"]
 users_col = db["users"]
 subs_col = db["subscriptions"]
+broadcasts_col = db["broadcasts"]
+fsm_col = db["fsm"]
+jobs_col = db["jobs"]
+migrations_col = db["migrations"]
+orders_col = db["orders"]
+counters_col = db["counters"]
+proof_hashes_col = db["proof_hashes"]
+categories_col = db["categories"]
+plans_col = db["plans"]
+approvals_col = db["approvals"]
+
+# ================= FSM STORAGE =================
+# Handlers usually do update_data() + set_state() back to back. Inside an
+# update, writes are buffered per key and FSMFlushMiddleware saves them once
+# the handler returns, so such a pair costs a single upsert and the update
+# only finishes after it is stored. Stale states expire through a TTL index
+# on updated_at.
+fsm_keys = contextvars.ContextVar("fsm_keys", default=None)
+
+class MongoStorage(BaseStorage):
+    def __init__(self, col):
+        self.col = col
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self.pending = {}
+        self.inflight = {}
+        self.locks = {}  # key -> [lock, users]
+
+    async def buffer(self, key, field, value):
+        k = self.key_builder.build(key)
+        self.pending.setdefault(k, {})[field] = value
+        keys = fsm_keys.get()
+        if keys is None:
+            # outside an update (jobs, web handlers): write right away
+            await self.flush(k)
+        else:
+            keys.add(k)
+
+    async def flush(self, k):
+        entry = self.locks.get(k)
+        if entry is None:
+            entry = self.locks[k] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # one writer per key keeps the writes in order
+            async with entry[0]:
+                fields = self.pending.pop(k, None)
+                if fields is None:
+                    # already saved by a concurrent flush of the same key
+                    return
+                self.inflight[k] = fields
+                try:
+                    await self.write(k, fields)
+                except PyMongoError:
+                    # keep them for the next flush, newer fields win
+                    self.pending[k] = {**fields, **self.pending.get(k, {})}
+                    raise
+                finally:
+                    self.inflight.pop(k, None)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[k]
+
+    async def write(self, k, fields):
+        if fields.get("state", 0) is None and fields.get("data", 0) == {}:
+            # state.clear()
+            await self.col.delete_one({"_id": k})
+            return
+        await self.col.update_one(
+            {"_id": k},
+            {"$set": {**fields, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def load(self, key):
+        k = self.key_builder.build(key)
+        overlay = {**self.inflight.get(k, {}), **self.pending.get(k, {})}
+        if "state" in overlay and "data" in overlay:
+            return overlay
+        doc = await self.col.find_one({"_id": k}, {"state": 1, "data": 1}) or {}
+        return {**doc, **overlay}
+
+    async def set_state(self, key, state=None):
+        await self.buffer(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        return (await self.load(key)).get("state")
+
+    async def set_data(self, key, data):
+        await self.buffer(key, "data", dict(data))
+
+    async def get_data(self, key):
+        return dict((await self.load(key)).get("data") or {})
+
+    async def close(self):
+        for k in list(self.pending):
+            try:
+                await self.flush(k)
+            except PyMongoError as e:
+                logging.warning("FSM write for %s lost on shutdown: %s", k, e)
+
+class FSMFlushMiddleware(BaseMiddleware):
+    # A failed write is retried a few times. If it still fails the fields
+    # stay pending, the user is told their last step was not saved and the
+    # update fails, instead of the handler's reply standing as if it was.
+    def __init__(self, storage, attempts=3):
+        self.storage = storage
+        self.attempts = attempts
+
+    async def save(self, k):
+        for attempt in range(self.attempts):
+            try:
+                return await self.storage.flush(k)
+            except PyMongoError:
+                if attempt == self.attempts - 1:
+                    raise
+                await asyncio.sleep(0.2 * 2 ** attempt)
+
+    async def __call__(self, handler, event, data):
+        keys = set()
+        token = fsm_keys.set(keys)
+        try:
+            return await handler(event, data)
+        finally:
+            fsm_keys.reset(token)
+            results = await asyncio.gather(*(self.save(k) for k in keys), return_exceptions=True)
+            failed = next((r for r in results if isinstance(r, Exception)), None)
+            if failed:
+                chat = data.get("event_chat")
+                if chat:
+                    try:
+                        await bot.send_message(chat.id, "⚠️ Your last step could not be saved. Please try again.")
+                    except TelegramAPIError as e:
+                        logging.warning("FSM save notice to %s failed: %s", chat.id, e)
+                raise failed
+
+def make_fsm_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise RuntimeError("FSM_STORAGE=redis needs the 'redis' package (pip install redis)")
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    return MongoStorage(fsm_col)
 
 # ================= BOT =================
 bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(
+    storage=make_fsm_storage(),
+    events_isolation=update_ordering if UPDATE_ORDERING else None
+)
+if UPDATE_ORDERING:
+    dp.update.outer_middleware(UnkeyedUpdateLimit(update_ordering))
+if isinstance(dp.storage, MongoStorage):
+    # runs inside FSMContextMiddleware's isolation lock, so the buffered
+    # writes are saved before the user's next update reads the state
+    dp.update.outer_middleware(FSMFlushMiddleware(dp.storage))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+if PROFILE_SLOW_MS > 0:
+    dp.message.middleware(ProfilingMiddleware())
+    dp.callback_query.middleware(ProfilingMiddleware())
 
 # ================= DATA =================
 DEFAULT_CATEGORIES = {
@@ -79,32 +637,1370 @@ class UserState(StatesGroup):
     set_channel_id = State()
     set_group_id = State()
 
-# ================= HELPERS =================
-async def get_settings():
+    waiting_for_statement = State()
+
+# ================= SETTINGS CACHE =================
+# The settings document changes a few times a day but is read on almost every
+# update, so it is kept in memory. Every write goes through update_settings(),
+# which bumps the document "version"; other processes pick the new version up
+# via a change stream (or polling when change streams are unavailable).
+# Catalog writes (categories / plans collections) bump it too, so the version
+# doubles as the invalidation signal for the catalog and markup caches.
+settings_cache = {"doc": None, "version": -1, "hits": 0, "misses": 0, "reloads": 0}
+settings_lock = asyncio.Lock()
+
+def store_settings(doc):
+    if doc is None:
+        return
+    version = doc.get("version", 0)
+    # never go back to an older version (late poll / out-of-order event)
+    if settings_cache["doc"] is not None and version < settings_cache["version"]:
+        return
+
+    old = settings_cache["doc"]
+    if old is not None and old.get("upi_id") != doc.get("upi_id"):
+        qr_cache.clear()
+    if version != settings_cache["version"]:
+        catalog_cache.clear()
+
+    settings_cache["doc"] = doc
+    settings_cache["version"] = version
+
+async def load_settings():
     s = await settings_col.find_one({"_id": "main"})
     if not s:
         s = {
             "_id": "main",
             "upi_id": "nohasheldendsouza@oksbi",
-            "categories": DEFAULT_CATEGORIES
+            # moved to categories_col by migrate_catalog() on startup
+            "categories": DEFAULT_CATEGORIES,
+            "version": 0
         }
-        await settings_col.insert_one(s)
-    return s
+        try:
+            await settings_col.insert_one(s)
+        except DuplicateKeyError:
+            s = await settings_col.find_one({"_id": "main"})
+
+    settings_cache["reloads"] += 1
+    store_settings(s)
+    return settings_cache["doc"]
+
+async def get_settings():
+    if settings_cache["doc"] is not None:
+        settings_cache["hits"] += 1
+        return settings_cache["doc"]
 
-def generate_upi_qr(upi):
-    qr = qrcode.make(f"upi://pay?pa={upi}&cu=INR")
+    settings_cache["misses"] += 1
+    async with settings_lock:
+        if settings_cache["doc"] is None:
+            await load_settings()
+    return settings_cache["doc"]
+
+async def update_settings(update):
+    # make sure the document exists before the first write
+    await get_settings()
+
+    update = dict(update)
+    update["$inc"] = {**update.get("$inc", {}), "version": 1}
+
+    doc = await settings_col.find_one_and_update(
+        {"_id": "main"},
+        update,
+        return_document=ReturnDocument.AFTER
+    )
+    store_settings(doc)
+    return doc
+
+async def poll_settings():
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            s = await settings_col.find_one({"_id": "main"}, {"version": 1})
+            if s and s.get("version", 0) > settings_cache["version"]:
+                await load_settings()
+        except PyMongoError as e:
+            logging.warning("Settings poll failed: %s", e)
+
+async def settings_sync():
+    while True:
+        try:
+            pipeline = [{"$match": {"documentKey._id": "main"}}]
+            async with settings_col.watch(pipeline, full_document="updateLookup") as stream:
+                logging.info("Settings sync: change stream active")
+                async for change in stream:
+                    if change["operationType"] == "delete":
+                        settings_cache["doc"] = None
+                    elif change.get("fullDocument"):
+                        store_settings(change["fullDocument"])
+        except OperationFailure as e:
+            # standalone servers have no change streams
+            logging.warning("Settings change stream unavailable (%s), polling every %ss", e, SETTINGS_POLL_INTERVAL)
+            return await poll_settings()
+        except PyMongoError as e:
+            logging.warning("Settings change stream error: %s", e)
+            await asyncio.sleep(5)
+
+def settings_cache_stats():
+    total = settings_cache["hits"] + settings_cache["misses"]
+    return {
+        "version": settings_cache["version"],
+        "hits": settings_cache["hits"],
+        "misses": settings_cache["misses"],
+        "reloads": settings_cache["reloads"],
+        "hit_rate": settings_cache["hits"] / total if total else 0.0
+    }
+
+# ================= HELPERS =================
+class LRUCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        value, expires = item
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return None
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.data[key] = (value, expires)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        item = self.data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+def upi_uri(upi, amount=None, note=None, ref=None):
+    params = [("pa", upi)]
+    if amount:
+        params += [("pn", UPI_PAYEE_NAME), ("am", amount)]
+    params.append(("cu", "INR"))
+    if note:
+        params.append(("tn", note))
+    if ref:
+        params.append(("tr", ref))
+    return "upi://pay?" + "&".join(f"{k}={quote(str(v), safe='@.')}" for k, v in params)
+
+def parse_amount(price):
+    # "199 INR" / "₹99.5" / "₹1,299/-" -> "199.00" / "99.50" / "1299.00"
+    cleaned = re.sub(r"[,\s]", "", str(price))
+    match = re.search(r"\d+(?:\.\d{1,2})?", cleaned)
+    if not match or float(match.group()) <= 0:
+        return None
+    return f"{float(match.group()):.2f}"
+
+def plan_ref(cat, plan_id):
+    return re.sub(r"[^A-Za-z0-9]", "", f"{cat}{plan_id}")[:35]
+
+def plan_upi_uri(upi, cat, plan_id, plan, amount=None):
+    note = re.sub(r"[^A-Za-z0-9 ]", "", f"VIP {cat} {plan['label']}").strip()[:50]
+    return upi_uri(upi, amount or parse_amount(plan["price"]), note, plan_ref(cat, plan_id))
+
+def tagged_amount(amount, tag):
+    # "199.00" + 37 -> "199.37"
+    paise = round(float(amount) * 100) + tag
+    return f"{paise // 100}.{paise % 100:02d}"
+
+def render_tag_qrs(upi, cat, plan_id, plan):
+    # one QR per paise tag, index = tag - 1
+    amount = parse_amount(plan["price"])
+    if not UPI_AMOUNT_TAGS or not amount:
+        return []
+    tags = []
+    for tag in range(1, UPI_AMOUNT_TAGS + 1):
+        uri = plan_upi_uri(upi, cat, plan_id, plan, tagged_amount(amount, tag))
+        tags.append({"uri": uri, "png": generate_upi_qr(uri), "file_id": None})
+    return tags
+
+def new_order_ref():
+    return secrets.token_hex(4).upper()
+
+def generate_upi_qr(uri):
+    qr = qrcode.make(uri)
     bio = io.BytesIO()
     qr.save(bio, format="PNG")
-    bio.seek(0)
-    return bio
+    return bio.getvalue()
+
+# user ids that passed the passcode check
+verified_users = LRUCache(VERIFIED_CACHE_SIZE, ttl=VERIFIED_CACHE_TTL)
+
+# uri -> {"png": bytes, "file_id": telegram file_id after the first upload}
+qr_cache = LRUCache(QR_CACHE_SIZE)
+
+async def get_upi_qr(uri):
+    entry = qr_cache.get(uri)
+    if entry is None:
+        # qrcode + PNG encoding is CPU work, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(None, generate_upi_qr, uri)
+        entry = {"png": png, "file_id": None}
+        qr_cache.set(uri, entry)
+    return entry
+
+def qr_photo(entry):
+    return entry.get("file_id") or types.BufferedInputFile(entry["png"], "upi.png")
+
+# Plan QR codes are rendered when an admin saves a plan and stored on the plan
+# document, so proceed_payment only has to look them up.
+async def render_plan_qr(chat_id, cat, plan_id, plan, preview=True):
+    settings = await get_settings()
+    uri = plan_upi_uri(settings["upi_id"], cat, plan_id, plan)
+
+    loop = asyncio.get_running_loop()
+    png, tags = await asyncio.gather(
+        loop.run_in_executor(None, generate_upi_qr, uri),
+        loop.run_in_executor(None, render_tag_qrs, settings["upi_id"], cat, plan_id, plan)
+    )
+
+    # upload once to get a file_id payments can reuse
+    file_id = None
+    try:
+        sent = await bot.send_photo(
+            chat_id,
+            types.BufferedInputFile(png, "upi.png"),
+            caption=f"🔳 Payment QR – {plan['label']} – {plan['price']}"
+        )
+        file_id = sent.photo[-1].file_id
+        if not preview:
+            await bot.delete_message(chat_id, sent.message_id)
+    except TelegramAPIError as e:
+        logging.warning("QR upload for plan %s failed: %s", plan_id, e)
+
+    await plans_col.update_one(
+        {"_id": plan_id},
+        {"$set": {"qr": {"uri": uri, "png": png, "file_id": file_id, "tags": tags}}}
+    )
+    await touch_catalog()
+
+# plans migrated out of settings keep their old id here, unique per category
+LEGACY_PLAN_INDEX = (
+    [("category", 1), ("legacy_id", 1)],
+    {"unique": True, "partialFilterExpression": {"legacy_id": {"$exists": True}}}
+)
+
+# (collection, keys, options) created idempotently at startup
+INDEXES = [
+    # start_cmd / check_passcode / broadcasts
+    (users_col, [("user_id", 1)], {"unique": True}),
+    # /msg @username
+    (users_col, [("username", 1)], {}),
+    # one subscription per user and category, renewals extend it
+    (subs_col, [("user_id", 1), ("category", 1)], {"unique": True}),
+    # active / per-category broadcasts in user_id order
+    (subs_col, [("status", 1), ("user_id", 1)], {}),
+    (subs_col, [("status", 1), ("category", 1), ("user_id", 1)], {}),
+    # next pending jobs / stale leases for the scheduler
+    (jobs_col, [("status", 1), ("run_at", 1)], {}),
+    (jobs_col, [("status", 1), ("locked_until", 1)], {}),
+    # jobs claimed by one scheduler pass
+    (jobs_col, [("locked_by", 1)], {}),
+    # broadcasts to resume
+    (broadcasts_col, [("status", 1), ("lease_until", 1)], {}),
+    # review queue: pending orders oldest first
+    (orders_col, [("status", 1), ("created_at", 1), ("_id", 1)], {}),
+    # per-reviewer queue / backlog
+    (orders_col, [("status", 1), ("assigned_to", 1), ("created_at", 1), ("_id", 1)], {}),
+    # reviewer approval times
+    (orders_col, [("status", 1), ("reviewed_at", 1)], {}),
+    # near-duplicate proof lookup (multikey), newest first / same Telegram file
+    (proof_hashes_col, [("bands", 1), ("created_at", -1)], {}),
+    (proof_hashes_col, [("file_unique_id", 1)], {}),
+    # proof cards sent before orders existed, one order per card
+    (orders_col, [("legacy_key", 1)], {"unique": True, "sparse": True}),
+    # menus list categories / a category's plans in creation order
+    (categories_col, [("created_at", 1)], {}),
+    (plans_col, [("category", 1), ("created_at", 1)], {}),
+    # get_plan() for legacy ids that were renamed at migration
+    (plans_col, *LEGACY_PLAN_INDEX),
+]
+
+# (collection, index name) no query uses any more, dropped at startup
+OBSOLETE_INDEXES = [
+    # due-subscription scan, replaced by the job scheduler
+    (subs_col, "status_1_expires_at_1_reminder_sent_1"),
+    # band lookup before it was sorted by created_at
+    (proof_hashes_col, "bands_1"),
+]
+
+async def ensure_indexes():
+    indexes = list(INDEXES)
+    # abandoned checkouts / admin flows
+    if isinstance(dp.storage, MongoStorage):
+        indexes.append((fsm_col, [("updated_at", 1)], {"expireAfterSeconds": FSM_TTL}))
+
+    for col, name in OBSOLETE_INDEXES:
+        try:
+            await col.drop_index(name)
+        except OperationFailure:
+            pass  # already gone
+
+    for col, keys, opts in indexes:
+        try:
+            await col.create_index(keys, **opts)
+        except OperationFailure as e:
+            # e.g. duplicate user_id documents block the unique index
+            logging.error("Index %s on %s failed: %s", keys, col.name, e)
+
+# Representative filters for every query shape the bot issues, checked with
+# explain() at boot when QUERY_AUDIT=1
+def query_shapes():
+    now = datetime.utcnow()
+    return [
+        ("start_cmd", users_col, {"user_id": 1}, None),
+        ("/msg @username", users_col, {"username": "x"}, None),
+        ("users page", users_col, {"user_id": {"$gt": 0}}, [("user_id", 1)]),
+        ("users search", users_col, {"username": {"$regex": "^x"}}, [("user_id", 1)]),
+        ("broadcast all", users_col, {"user_id": {"$gt": 0}, "blocked": {"$ne": True}}, [("user_id", 1)]),
+        ("broadcast blocked", users_col, {"user_id": {"$in": [1, 2]}, "blocked": True}, None),
+        ("broadcast active", subs_col, {"status": "active", "user_id": {"$gt": 0}}, [("user_id", 1)]),
+        ("broadcast category", subs_col, {"status": "active", "category": "x", "user_id": {"$gt": 0}}, [("user_id", 1)]),
+        ("job backfill", subs_col, {"status": "active"}, None),
+        ("job heap", jobs_col, {"status": "pending"}, [("run_at", 1)]),
+        ("stale jobs", jobs_col, {"status": "running", "locked_until": {"$lt": now}}, None),
+        ("claimed jobs", jobs_col, {"locked_by": "x"}, None),
+        ("stale broadcasts", broadcasts_col, {"status": "running", "lease_until": {"$lt": now}}, None),
+        ("review queue", orders_col, {"status": "pending"}, [("created_at", 1), ("_id", 1)]),
+        ("legacy proof card", orders_col, {"legacy_key": "x"}, None),
+        ("proof band", proof_hashes_col, {"bands": 1, "bits": PROOF_HASH_BITS}, [("created_at", -1)]),
+        ("proof file", proof_hashes_col, {"file_unique_id": "x"}, None),
+        ("reviewer queue", orders_col, {"status": "pending", "assigned_to": 1}, [("created_at", 1), ("_id", 1)]),
+        ("reviewer backlog", orders_col, {"status": {"$in": ["pending", "approving"]}, "assigned_to": {"$in": [1]}}, None),
+        ("reviewer times", orders_col, {"status": "approved", "reviewed_at": {"$gte": now}}, None),
+        ("renewal", subs_col, {"user_id": 1, "category": "x"}, None),
+        ("categories menu", categories_col, {}, [("created_at", 1)]),
+        ("plans menu", plans_col, {"category": "x"}, [("created_at", 1)]),
+    ]
+
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for v in plan.values():
+            yield from plan_stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            yield from plan_stages(v)
+
+async def audit_queries():
+    for name, col, query, sort in query_shapes():
+        cursor = col.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        except (PyMongoError, KeyError) as e:
+            logging.warning("Query audit: %s: explain failed: %s", name, e)
+            continue
+
+        stages = set(plan_stages(plan))
+        if "COLLSCAN" in stages:
+            logging.warning("Query audit: %s on %s does a COLLSCAN: %s", name, col.name, query)
+        else:
+            logging.info("Query audit: %s ok (%s)", name, ", ".join(sorted(stages)))
+
+class BulkWriter:
+    def __init__(self, col, size=BULK_WRITE_SIZE):
+        self.col = col
+        self.size = size
+        self.ops = []
+
+    async def add(self, op):
+        self.ops.append(op)
+        if len(self.ops) >= self.size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.ops:
+            return
+        ops, self.ops = self.ops, []
+        await self.col.bulk_write(ops, ordered=False)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# ================= OUTBOUND =================
+# Every Bot API request passes through this session middleware. Requests wait
+# for a global token (highest priority first: interactive replies before
+# background notifications), messages additionally for a per-chat token, and
+# flood waits are retried.
+INTERACTIVE, BACKGROUND = 0, 1
+outbound_priority = contextvars.ContextVar("outbound_priority", default=INTERACTIVE)
+
+UNLIMITED_METHODS = {
+    "getUpdates", "getMe", "getFile", "setWebhook", "deleteWebhook",
+    "getWebhookInfo", "answerCallbackQuery"
+}
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAnimation",
+    "sendAudio", "sendVoice", "sendSticker", "sendMediaGroup",
+    "copyMessage", "forwardMessage"
+}
+
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE)
+        self.chat_buckets = LRUCache(10000)
+        self.waiting = []
+        self.seq = itertools.count()
+        self.pump_task = None
+        self.stats = {
+            "queued": 0, "sent": 0, "retries": 0, "errors": 0,
+            "latency_total": 0.0, "latency_max": 0.0
+        }
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(TG_CHAT_RATE)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def pump(self):
+        while self.waiting:
+            # drop waiters that were cancelled meanwhile
+            while self.waiting and self.waiting[0][2].done():
+                heapq.heappop(self.waiting)
+            if not self.waiting:
+                break
+            await self.global_bucket.acquire()
+            if self.waiting:
+                _, _, fut = heapq.heappop(self.waiting)
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def acquire(self, priority):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.seq), fut))
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.create_task(self.pump())
+
+        self.stats["queued"] += 1
+        started = time.perf_counter()
+        try:
+            await fut
+        finally:
+            self.stats["queued"] -= 1
+            add_io_time("queue", time.perf_counter() - started)
+
+    async def timed(self, make_request, bot, method, api):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError:
+            telegram_errors.inc(api)
+            raise
+        finally:
+            took = time.perf_counter() - started
+            telegram_seconds.observe(took, api)
+            add_io_time("telegram", took)
+
+    async def __call__(self, make_request, bot, method):
+        api = method.__api_method__
+        if api == "getUpdates":
+            return await make_request(bot, method)
+        if api in UNLIMITED_METHODS:
+            return await self.timed(make_request, bot, method, api)
+
+        chat_id = getattr(method, "chat_id", None) if api in MESSAGE_METHODS else None
+        priority = outbound_priority.get()
+        started = time.monotonic()
+
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if chat_id is not None:
+                await self.chat_bucket(chat_id).acquire()
+            await self.acquire(priority)
+
+            try:
+                result = await self.timed(make_request, bot, method, api)
+            except TelegramRetryAfter as e:
+                self.stats["retries"] += 1
+                if attempt == TG_MAX_RETRIES:
+                    self.stats["errors"] += 1
+                    raise
+                logging.warning("Flood wait %ss on %s", e.retry_after, api)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramAPIError as e:
+                self.stats["errors"] += 1
+                logging.warning("%s to %s failed: %s", api, getattr(method, "chat_id", "-"), e)
+                raise
+
+            took = time.monotonic() - started
+            self.stats["sent"] += 1
+            self.stats["latency_total"] += took
+            self.stats["latency_max"] = max(self.stats["latency_max"], took)
+            return result
+
+outbound = OutboundLimiter()
+bot.session.middleware(outbound)
+
+async def run_once(name):
+    # True for one process at a time until migration_done(name) records it;
+    # a worker that dies mid-migration leaves it to the next boot after JOB_LEASE
+    now = datetime.utcnow()
+    try:
+        await migrations_col.update_one(
+            {"_id": name, "ran_at": {"$exists": False}, "locked_until": {"$not": {"$gt": now}}},
+            {"$set": {"locked_by": WORKER_ID, "locked_until": now + timedelta(seconds=JOB_LEASE)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def migration_done(name):
+    await migrations_col.update_one(
+        {"_id": name},
+        {"$set": {"ran_at": datetime.utcnow(), "by": WORKER_ID, "locked_until": None}}
+    )
+
+# ================= ROLES =================
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+def is_reviewer(user_id):
+    # admins can always review
+    return user_id in REVIEWER_IDS or user_id in ADMIN_IDS
+
+# ================= CATALOG =================
+# Categories (_id = category key) and plans (_id = generated id, "category"
+# points at the key) live in their own collections. Readers fetch one
+# category or one category's plans and cache the result under the current
+# settings version; writers call touch_catalog() to move the version on.
+catalog_cache = LRUCache(CATALOG_CACHE_SIZE)
+
+async def touch_catalog():
+    await update_settings({})
+
+async def catalog_cached(key, load):
+    version = (await get_settings()).get("version", 0)
+    # entries loaded under an older version are simply never hit again
+    value = catalog_cache.get((version, *key))
+    if value is None:
+        value = await load()
+        if value is not None:
+            catalog_cache.set((version, *key), value)
+    return value
+
+async def get_categories():
+    return await catalog_cached(
+        ("categories",),
+        lambda: categories_col.find().sort("created_at", 1).to_list(None)
+    )
+
+async def get_category(key):
+    return await catalog_cached(("category", key), lambda: categories_col.find_one({"_id": key}))
+
+async def get_plans(cat):
+    # listings never need the QR bytes
+    return await catalog_cached(
+        ("plans", cat),
+        lambda: plans_col.find({"category": cat}, {"qr": 0}).sort("created_at", 1).to_list(None)
+    )
+
+async def get_plan(cat, plan_id):
+    async def load():
+        plan = await plans_col.find_one({"_id": plan_id})
+        if plan and plan["category"] == cat:
+            return plan
+        # legacy id another category's plan already had at migration
+        return await plans_col.find_one({"category": cat, "legacy_id": plan_id})
+    return await catalog_cached(("plan", cat, plan_id), load)
+
+def new_plan_id():
+    return str(ObjectId())
+
+async def migrate_legacy_plan(cat, plan_id, fields):
+    try:
+        await plans_col.update_one(
+            {"_id": plan_id, "category": cat},
+            {"$setOnInsert": fields},
+            upsert=True
+        )
+        return
+    except DuplicateKeyError:
+        owner = await plans_col.find_one({"_id": plan_id}, {"category": 1})
+        if owner and owner["category"] == cat:
+            return
+    # int(loop.time()) ids collide across categories: this one gets a fresh
+    # id, get_plan() still finds it by (category, legacy id)
+    await plans_col.update_one(
+        {"category": cat, "legacy_id": plan_id},
+        {"$setOnInsert": {**fields, "_id": new_plan_id()}},
+        upsert=True
+    )
+
+async def legacy_plan_written(cat, plan_id):
+    return await plans_col.count_documents(
+        {"category": cat, "$or": [{"_id": plan_id}, {"legacy_id": plan_id}]}, limit=1
+    ) > 0
+
+async def migrate_catalog():
+    # one-time move out of settings["categories"]; upserts make a rerun after
+    # a crash harmless, the embedded copy is only dropped once all is written
+    settings = await load_settings()
+    if "categories" not in settings:
+        return
+
+    # before the upserts, so two replicas migrating at once can't both add a
+    # fresh-id copy of the same colliding plan
+    await plans_col.create_index(LEGACY_PLAN_INDEX[0], **LEGACY_PLAN_INDEX[1])
+
+    base = datetime.utcnow()
+    written = []
+    for i, (key, cat) in enumerate(settings["categories"].items()):
+        plans = cat.get("plans", {})
+        doc = {k: v for k, v in cat.items() if k != "plans"}
+        await categories_col.update_one(
+            {"_id": key},
+            {"$setOnInsert": {**doc, "created_at": base + timedelta(milliseconds=i)}},
+            upsert=True
+        )
+        # legacy plan ids are kept, pending proofs and subscriptions use them
+        for j, (plan_id, plan) in enumerate(plans.items()):
+            await migrate_legacy_plan(key, plan_id, {
+                **plan,
+                "category": key,
+                "legacy_id": plan_id,
+                "created_at": base + timedelta(milliseconds=i * 1000 + j)
+            })
+            written.append((key, plan_id))
+
+    missing = [p for p in written if not await legacy_plan_written(*p)]
+    if missing:
+        logging.error("Catalog: %s plans not migrated, keeping settings.categories: %s",
+                      len(missing), missing)
+        return
+
+    await update_settings({"$unset": {"categories": ""}})
+    logging.info("Catalog: moved %s categories and %s plans out of settings",
+                 len(settings["categories"]), len(written))
+
+# ================= KEYBOARDS =================
+# Menus only change with the catalog, so each one is built once per settings
+# version and the same markup object is handed out afterwards.
+MAIN_MENU_KB = types.ReplyKeyboardMarkup(
+    keyboard=[[
+        types.KeyboardButton(text="💎 Buy VIP Membership"),
+        types.KeyboardButton(text="❓ Help")
+    ]],
+    resize_keyboard=True
+)
+ADMIN_MAIN_MENU_KB = types.ReplyKeyboardMarkup(
+    keyboard=MAIN_MENU_KB.keyboard + [[types.KeyboardButton(text="⚙️ Admin Panel")]],
+    resize_keyboard=True
+)
+ADMIN_PANEL_KB = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="👥 Users")],
+        [types.KeyboardButton(text="🧾 Review Queue")],
+        [types.KeyboardButton(text="💰 Manage Categories")],
+        [types.KeyboardButton(text="📢 Force Subscribe")],
+        [types.KeyboardButton(text="⬅️ Back")]
+    ],
+    resize_keyboard=True
+)
+
+ADMIN_CATEGORY_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Add Plan", callback_data="admin_add_plan")],
+    [InlineKeyboardButton(text="✏️ Edit Plan", callback_data="admin_edit_plan")],
+    [InlineKeyboardButton(text="🗑 Delete Plan", callback_data="admin_delete_plan")],
+    [InlineKeyboardButton(text="🔗 Set Channel ID", callback_data="admin_set_channel")],
+    [InlineKeyboardButton(text="👥 Set Group ID", callback_data="admin_set_group")],
+    [InlineKeyboardButton(text="⬅️ Back", callback_data="admin_back_categories")]
+])
+
+def main_menu_kb(user_id):
+    return ADMIN_MAIN_MENU_KB if is_admin(user_id) else MAIN_MENU_KB
+
+async def build_categories_kb(with_price):
+    kb = InlineKeyboardBuilder()
+    for cat in await get_categories():
+        text = f"{cat['name']} ({cat['price']})" if with_price else cat["name"]
+        kb.button(text=text, callback_data=f"cat_{cat['_id']}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+async def build_plans_kb(cat_key):
+    category, plans = await asyncio.gather(get_category(cat_key), get_plans(cat_key))
+    kb = InlineKeyboardBuilder()
+    for plan in plans:
+        kb.button(
+            text=f"{category['name']} – {plan['label']} – {plan['price']}",
+            callback_data=f"plan_{plan['_id']}"
+        )
+
+    kb.button(text="⬅️ Back", callback_data="back_to_categories")
+    kb.adjust(1)
+    return kb.as_markup()
+
+async def build_admin_categories_kb():
+    kb = InlineKeyboardBuilder()
+    for cat in await get_categories():
+        kb.button(text=cat["name"], callback_data=f"admin_cat_{cat['_id']}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+async def build_admin_plans_kb(cat_key, action):
+    kb = InlineKeyboardBuilder()
+    for plan in await get_plans(cat_key):
+        pid = plan["_id"]
+        if action == "delete":
+            kb.button(text=f"🗑 {plan['label']} – {plan['price']}", callback_data=f"delplan_{pid}")
+        else:
+            kb.button(text=f"{plan['label']} – {plan['price']}", callback_data=f"editplan_{pid}")
+
+    kb.button(text="⬅️ Back", callback_data="admin_cat_back")
+    kb.adjust(1)
+    return kb.as_markup()
+
+MARKUP_BUILDERS = {
+    "categories": build_categories_kb,
+    "plans": build_plans_kb,
+    "admin_categories": build_admin_categories_kb,
+    "admin_plans": build_admin_plans_kb
+}
+markup_cache = {"version": None, "items": {}}
+
+async def cached_markup(name, *args):
+    version = (await get_settings()).get("version", 0)
+    if markup_cache["version"] != version:
+        markup_cache["items"].clear()
+        markup_cache["version"] = version
+
+    key = (name, *args)
+    markup = markup_cache["items"].get(key)
+    if markup is None:
+        markup = await MARKUP_BUILDERS[name](*args)
+        # a catalog write while building → don't file it under the new version
+        if markup_cache["version"] == version:
+            markup_cache["items"][key] = markup
+    return markup
+
+# ================= USERS BROWSER =================
+# Keyset pagination on user_id: every page is one indexed range query with a
+# projection, no matter how deep into the list the admin goes.
+USERS_PROJECTION = {"_id": 0, "user_id": 1, "username": 1, "joined_at": 1}
+users_count_cache = {"value": 0, "at": 0.0}
+
+async def users_total():
+    if time.monotonic() - users_count_cache["at"] > USERS_COUNT_TTL:
+        users_count_cache["value"] = await users_col.estimated_document_count()
+        users_count_cache["at"] = time.monotonic()
+    return users_count_cache["value"]
+
+USER_ID_DIGITS = 16  # longest user_id searched for
+
+def users_search_query(search):
+    # None when the search can't match any user_id
+    search = search.lstrip("@")
+    if not search.isdigit() or search.startswith("0"):
+        # anchored, case-sensitive → served by the username index
+        return {"username": {"$regex": f"^{re.escape(search)}"}}
+    if len(search) > USER_ID_DIGITS:
+        return None
+
+    # ids starting with these digits = one user_id range per id length
+    prefix, ranges = int(search), []
+    for extra in range(0, USER_ID_DIGITS + 1 - len(search)):
+        low = prefix * 10 ** extra
+        ranges.append({"user_id": {"$gte": low, "$lt": low + 10 ** extra}})
+    return {"$or": ranges}
+
+async def render_users_page(search, after=None, before=None):
+    query = users_search_query(search) if search else {}
+    direction = 1
+    if before is not None:
+        query = {"$and": [query, {"user_id": {"$lt": before}}]}
+        direction = -1
+    elif after is not None:
+        query = {"$and": [query, {"user_id": {"$gt": after}}]}
+
+    cursor = users_col.find(query, USERS_PROJECTION).sort("user_id", direction)
+    docs = await cursor.limit(USERS_PAGE_SIZE + 1).to_list(None)
+    more = len(docs) > USERS_PAGE_SIZE
+    docs = docs[:USERS_PAGE_SIZE]
+    if direction == -1:
+        docs.reverse()
+
+    has_prev = more if before is not None else after is not None
+    has_next = more if before is None else True
+
+    if search:
+        # capped: a short prefix can match most of the collection
+        matches = await users_col.count_documents(users_search_query(search), limit=USERS_MATCH_COUNT_CAP + 1)
+        shown = f"{USERS_MATCH_COUNT_CAP}+" if matches > USERS_MATCH_COUNT_CAP else matches
+        header = f"🔎 Users matching <code>{html.escape(search)}</code>\nMatches: {shown}\n"
+    else:
+        header = f"👥 USERS LIST\nTotal users: {await users_total()}\n"
+    lines = [header]
+    for u in docs:
+        lines.append(
+            f"• {html.escape(u.get('username') or 'N/A')} – "
+            f"<code>{u['user_id']}</code> – {u.get('joined_at', 'N/A')}"
+        )
+    if not docs:
+        lines.append("No users found.")
+    lines.append(
+        "\n✉️ /msg user_id|@username message\n"
+        "🔎 /users name or id prefix"
+    )
+
+    nav = []
+    if docs and has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Prev", callback_data=f"users_p_{docs[0]['user_id']}"))
+    if docs and has_next:
+        nav.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"users_n_{docs[-1]['user_id']}"))
+
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[nav] if nav else [])
+
+# ================= REVIEW QUEUE =================
+# Pending orders oldest first, keyset-paged on (created_at, _id). The page
+# start and the multi-selection live in the admin's FSM data.
+ORDER_PROJECTION = {
+    "ref": 1, "user_id": 1, "user_name": 1, "category_name": 1,
+    "plan_label": 1, "price": 1, "created_at": 1, "duplicate_of": 1
+}
+
+async def render_queue_page(selected, cursor=None, reviewer=None):
+    # reviewer=None → every pending order (admins)
+    query = {"status": "pending"}
+    if reviewer is not None:
+        query["assigned_to"] = reviewer
+    if cursor:
+        anchor = await orders_col.find_one({"_id": ObjectId(cursor)}, {"created_at": 1})
+        if anchor:
+            query["$or"] = [
+                {"created_at": {"$gt": anchor["created_at"]}},
+                {"created_at": anchor["created_at"], "_id": {"$gt": anchor["_id"]}}
+            ]
+
+    docs, total = await asyncio.gather(
+        orders_col.find(query, ORDER_PROJECTION)
+        .sort([("created_at", 1), ("_id", 1)])
+        .limit(QUEUE_PAGE_SIZE + 1)
+        .to_list(None),
+        orders_col.count_documents({k: v for k, v in query.items() if k != "$or"})
+    )
+    has_next = len(docs) > QUEUE_PAGE_SIZE
+    docs = docs[:QUEUE_PAGE_SIZE]
+
+    lines = [f"🧾 <b>Review Queue</b>\nPending: {total} · Selected: {len(selected)}\n"]
+    rows = []
+    for n, o in enumerate(docs, 1):
+        oid = str(o["_id"])
+        lines.append(
+            f"{n}. {'⚠️ ' if o.get('duplicate_of') else ''}<code>{o['ref']}</code> · "
+            f"{html.escape(o.get('user_name') or str(o['user_id']))} · "
+            f"{html.escape(o['category_name'])} / {html.escape(o['plan_label'])} · "
+            f"{html.escape(o['price'])} · {o['created_at'].strftime('%d %b %H:%M')}"
+        )
+        rows.append([
+            InlineKeyboardButton(
+                text=f"{'☑️' if oid in selected else '⬜'} {n}. {o['ref']}",
+                callback_data=f"queue_t_{oid}"
+            ),
+            InlineKeyboardButton(text="👁", callback_data=f"queue_v_{oid}")
+        ])
+    if not docs:
+        lines.append("✅ Nothing to review." if not cursor else "No more pending orders.")
+
+    if selected:
+        rows.append([
+            InlineKeyboardButton(text=f"✅ Approve ({len(selected)})", callback_data="queue_ok"),
+            InlineKeyboardButton(text=f"❌ Reject ({len(selected)})", callback_data="queue_no")
+        ])
+    if docs:
+        rows.append([
+            InlineKeyboardButton(text="☑️ Page", callback_data="queue_all"),
+            InlineKeyboardButton(text="⬜ None", callback_data="queue_none")
+        ])
+
+    nav = []
+    if cursor:
+        nav.append(InlineKeyboardButton(text="⏮ First", callback_data="queue_first"))
+    nav.append(InlineKeyboardButton(text="🔄", callback_data="queue_refresh"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"queue_n_{docs[-1]['_id']}"))
+    rows.append(nav)
+
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows), [str(o["_id"]) for o in docs]
+
+# ================= REVIEWERS =================
+# Proofs and help requests go to one reviewer each. least_loaded picks the
+# reviewer with the fewest open orders, round_robin walks REVIEWER_IDS with a
+# shared counter so several processes keep one rotation.
+def queue_scope(user_id):
+    return None if is_admin(user_id) else user_id
+
+async def reviewer_backlogs():
+    pipeline = [
+        {"$match": {"status": {"$in": ["pending", "approving"]}, "assigned_to": {"$in": REVIEWER_IDS}}},
+        {"$group": {"_id": "$assigned_to", "n": {"$sum": 1}}}
+    ]
+    counts = {r: 0 for r in REVIEWER_IDS}
+    async for row in orders_col.aggregate(pipeline):
+        counts[row["_id"]] = row["n"]
+    return counts
+
+async def next_round_robin():
+    doc = await counters_col.find_one_and_update(
+        {"_id": "reviewer_rr"},
+        {"$inc": {"n": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return REVIEWER_IDS[doc["n"] % len(REVIEWER_IDS)]
+
+async def pick_reviewer():
+    if len(REVIEWER_IDS) == 1:
+        return REVIEWER_IDS[0]
+    try:
+        if ASSIGN_STRATEGY == "round_robin":
+            return await next_round_robin()
+        backlogs = await reviewer_backlogs()
+        lowest = min(backlogs.values())
+        tied = [r for r in REVIEWER_IDS if backlogs[r] == lowest]
+        # spread ties instead of always loading the first reviewer
+        return tied[0] if len(tied) == 1 else random.choice(tied)
+    except PyMongoError as e:
+        logging.warning("Reviewer assignment failed, using first reviewer: %s", e)
+        return REVIEWER_IDS[0]
+
+async def reviewer_stats():
+    since = datetime.utcnow() - timedelta(days=REVIEWER_STATS_DAYS)
+    times = {}
+    cursor = orders_col.find(
+        {"status": "approved", "reviewed_at": {"$gte": since}},
+        {"_id": 0, "reviewed_by": 1, "created_at": 1, "reviewed_at": 1}
+    )
+    async for o in cursor:
+        times.setdefault(o.get("reviewed_by"), []).append(
+            (o["reviewed_at"] - o["created_at"]).total_seconds()
+        )
+
+    backlogs = await reviewer_backlogs()
+    stats = {}
+    for r in sorted(set(REVIEWER_IDS) | {k for k in times if k is not None}):
+        t = times.get(r, [])
+        stats[r] = {
+            "backlog": backlogs.get(r, 0),
+            "approved": len(t),
+            "median_seconds": statistics.median(t) if t else None
+        }
+    return stats
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
+
+# ================= RECONCILIATION =================
+# Bank / UPI statement CSVs are spooled to a temp file and read row by row.
+# Pending orders are indexed in memory once per import; a credit row whose
+# text contains an order reference, with the same amount and a date inside
+# the window, approves that order through approve_order(). Amount-only
+# matches are never approved, several users often pay the same price. With
+# UPI_AMOUNT_TAGS, a dated credit whose amount belongs to exactly one tagged
+# pending order in the window is listed for one-tap approval by an admin.
+ORDER_REF_RE = re.compile(r"(?<![0-9A-F])[0-9A-F]{8}(?![0-9A-F])")
+STATEMENT_DATE_FORMATS = (
+    "%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y", "%d/%m/%Y %H:%M:%S", "%d/%m/%y",
+    "%d-%m-%Y", "%d-%m-%Y %H:%M:%S", "%d %b %Y", "%d-%b-%Y", "%d-%b-%y", "%d %b %Y %H:%M"
+)
+
+def statement_columns(header):
+    names = [h.strip().lower() for h in header]
+
+    def find(*words):
+        for i, n in enumerate(names):
+            if any(w in n for w in words):
+                return i
+        return None
+
+    # a credit column beats a signed amount column
+    credit = find("credit", "deposit", "cr amount")
+    return {
+        "amount": credit if credit is not None else find("amount"),
+        "date": find("date", "time"),
+        "type": next((i for i, n in enumerate(names) if n in ("type", "dr/cr", "cr/dr", "txn type")), None)
+    }
+
+def statement_amount(cell):
+    cell = (cell or "").replace(",", "").strip()
+    if not cell or cell.startswith("-"):
+        return None
+    return parse_amount(cell)
+
+def statement_date(cell):
+    cell = (cell or "").strip()
+    for fmt in STATEMENT_DATE_FORMATS:
+        try:
+            return datetime.strptime(cell, fmt)
+        except ValueError:
+            pass
+    return None
+
+def in_window(order, paid_at):
+    # an undated row only gets this far with a reference match
+    if paid_at is None:
+        return True
+    # statement dates are local and often date-only, allow a day before
+    created = order["created_at"]
+    return created - timedelta(days=1) <= paid_at <= created + timedelta(hours=RECONCILE_WINDOW_HOURS)
+
+def ref_amount_matches(order, amount):
+    # with the reference in the note, paying the untagged price is fine too
+    return amount in (order["amount"], parse_amount(order.get("price", "")))
+
+async def reconcile_index():
+    since = datetime.utcnow() - timedelta(days=RECONCILE_LOOKBACK_DAYS)
+    by_ref, by_amount = {}, defaultdict(list)
+    cursor = orders_col.find(
+        {"status": "pending", "created_at": {"$gte": since}},
+        {"ref": 1, "amount": 1, "amount_tagged": 1, "price": 1, "created_at": 1}
+    )
+    async for o in cursor:
+        by_ref[o["ref"]] = o
+        by_amount[o["amount"]].append(o)
+    return by_ref, by_amount
+
+async def reconcile_file(f, admin_id):
+    report = {
+        "rows": 0, "credits": 0, "approved": 0, "already": 0, "failed": 0,
+        "amount_only": 0, "unmatched": 0, "suggested": []
+    }
+    rows = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace", newline=""))
+    header = next(rows, None)
+    cols = statement_columns(header or [])
+    if cols["amount"] is None:
+        report["error"] = "no amount / credit column in the header"
+        return report
+
+    by_ref, by_amount = await reconcile_index()
+    sem = asyncio.Semaphore(APPROVE_CONCURRENCY)
+    tasks = []
+
+    async def approve(order, row_no):
+        try:
+            result = await approve_order(order["_id"], admin_id)
+            if result:
+                await orders_col.update_one({"_id": order["_id"]}, {"$set": {
+                    "reconciled": {"row": row_no, "by": admin_id, "at": datetime.utcnow()}
+                }})
+            report["approved" if result else "already"] += 1
+        except Exception as e:
+            logging.warning("Reconcile: order %s failed: %s", order["_id"], e)
+            report["failed"] += 1
+        finally:
+            sem.release()
+
+    for row_no, row in enumerate(rows, 2):
+        report["rows"] += 1
+        if row_no % 500 == 0:
+            await asyncio.sleep(0)  # parsing is sync, let updates through
+        if len(row) <= cols["amount"]:
+            continue
+        if cols["type"] is not None and row[cols["type"]].strip().upper().startswith(("DR", "DEBIT")):
+            continue
+        amount = statement_amount(row[cols["amount"]])
+        if not amount:
+            continue
+        report["credits"] += 1
+
+        paid_at = statement_date(row[cols["date"]]) if cols["date"] is not None and len(row) > cols["date"] else None
+        text = " ".join(row).upper()
+        order = next((
+            by_ref[ref] for ref in ORDER_REF_RE.findall(text)
+            if ref in by_ref and ref_amount_matches(by_ref[ref], amount) and in_window(by_ref[ref], paid_at)
+        ), None)
+
+        if order is None:
+            # an undated row could be any of the pending orders at that price
+            candidates = [
+                o for o in by_amount.get(amount, []) if in_window(o, paid_at)
+            ] if paid_at else []
+            if not candidates:
+                report["unmatched"] += 1
+                continue
+            report["amount_only"] += 1
+            suggested = {s["order_id"] for s in report["suggested"]}
+            if (len(candidates) == 1 and candidates[0].get("amount_tagged")
+                    and str(candidates[0]["_id"]) not in suggested
+                    and len(report["suggested"]) < RECONCILE_SUGGESTIONS):
+                report["suggested"].append({
+                    "order_id": str(candidates[0]["_id"]),
+                    "ref": candidates[0]["ref"],
+                    "amount": amount,
+                    "row": row_no
+                })
+            continue
+
+        # one statement row settles one order
+        del by_ref[order["ref"]]
+        by_amount[order["amount"]].remove(order)
+        await sem.acquire()
+        tasks.append(asyncio.create_task(approve(order, row_no)))
+
+    await asyncio.gather(*tasks)
+    return report
+
+def format_reconcile_report(report):
+    if "error" in report:
+        return f"❌ Statement not usable: {report['error']}"
+    return (
+        "🏦 *Reconciliation done*\n\n"
+        f"📄 Rows: {report['rows']} ({report['credits']} credits)\n"
+        f"✅ Approved: {report['approved']}\n"
+        f"⏭ Already handled: {report['already']}\n"
+        f"❌ Failed: {report['failed']}\n"
+        f"🔍 Amount matches without reference: {report['amount_only']} (review manually)\n"
+        f"➖ Unmatched credits: {report['unmatched']}"
+        + ("\n\n🏷 Tagged amount matches below, check and tap to approve" if report["suggested"] else "")
+    )
+
+def reconcile_suggestions_kb(report):
+    if not report.get("suggested"):
+        return None
+    # same callback as the Approve button on the proof card
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"✅ {s['ref']} · ₹{s['amount']} (row {s['row']})",
+            callback_data=f"approve_{s['order_id']}"
+        )]
+        for s in report["suggested"]
+    ])
+
+# ================= LOOP MONITOR =================
+loop_stats = {"lag": 0.0, "max_lag": 0.0}
+ready_cache = {"telegram": None, "checked": 0.0}
+
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    if SLOW_CALLBACK_MS > 0:
+        # asyncio logs every callback that holds the loop longer than this
+        # ("Executing <Task ...> took 0.350 seconds") on the asyncio logger
+        loop.slow_callback_duration = SLOW_CALLBACK_MS / 1000
+        loop.set_debug(True)
+
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(loop.time() - started - LOOP_LAG_INTERVAL, 0)
+
+        loop_stats["lag"] = lag
+        loop_stats["max_lag"] = max(loop_stats["max_lag"], lag)
+        loop_lag_seconds.observe(lag)
+        if lag * 1000 > LOOP_LAG_READY_MS:
+            logging.warning("Event loop lagged %.0f ms", lag * 1000)
+
+async def telegram_reachable():
+    # getMe at most every 30s, readiness probes can be frequent
+    now = time.monotonic()
+    if ready_cache["telegram"] is None or now - ready_cache["checked"] > 30:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(bot.get_me(), 5)
+            ready_cache["telegram"] = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1)}
+        except Exception as e:
+            ready_cache["telegram"] = {"ok": False, "error": str(e) or type(e).__name__}
+        ready_cache["checked"] = now
+    return ready_cache["telegram"]
 
 # ================= WEB =================
 async def health(request):
     return web.Response(text="Bot running")
 
+async def ready(request):
+    lag_ms = round(loop_stats["lag"] * 1000, 1)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), 5)
+        mongo = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1)}
+    except (PyMongoError, asyncio.TimeoutError) as e:
+        mongo = {"ok": False, "error": str(e) or type(e).__name__}
+
+    body = {
+        "loop_lag_ms": lag_ms,
+        "loop_lag_max_ms": round(loop_stats["max_lag"] * 1000, 1),
+        "mongo": mongo,
+        "telegram": await telegram_reachable()
+    }
+    # Telegram is reported but not gating: restarting won't fix their outage
+    ok = lag_ms <= LOOP_LAG_READY_MS and mongo["ok"]
+    body["ready"] = ok
+    return web.json_response(body, status=200 if ok else 503)
+
+# the $group over the fsm collection is a full scan, run it once per interval
+fsm_counts_cache = {"counts": None, "checked": 0.0}
+
+async def fsm_state_counts():
+    storage = dp.storage
+    if isinstance(storage, MongoStorage):
+        now = time.monotonic()
+        if fsm_counts_cache["counts"] is None or now - fsm_counts_cache["checked"] > METRICS_FSM_INTERVAL:
+            pipeline = [{"$group": {"_id": "$state", "n": {"$sum": 1}}}]
+            fsm_counts_cache["counts"] = {
+                (r["_id"] or "none",): r["n"] async for r in fsm_col.aggregate(pipeline)
+            }
+            fsm_counts_cache["checked"] = now
+        return fsm_counts_cache["counts"]
+    if isinstance(storage, MemoryStorage):
+        counts = {}
+        for record in storage.storage.values():
+            key = (record.state or "none",)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+    return {}
+
+async def metrics(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+
+    out = []
+    for metric in (updates_total, handler_seconds, mongo_seconds, mongo_errors,
+                   telegram_seconds, telegram_errors, scheduler_pass_seconds,
+                   loop_lag_seconds, update_wait_seconds, update_key_depth):
+        out += metric.render()
+
+    try:
+        backlog = await jobs_col.count_documents(
+            {"status": "pending", "run_at": {"$lte": datetime.utcnow()}}
+        )
+        out += gauge("bot_scheduler_backlog", "Jobs due but not run yet", {(): backlog})
+        out += gauge("bot_fsm_states", "Stored FSM states", await fsm_state_counts(), ("state",))
+        out += gauge("bot_orders_pending", "Payment proofs waiting for review", {
+            (): await orders_col.count_documents({"status": "pending"})
+        })
+        out += gauge("bot_reviewer_backlog", "Open orders per reviewer", {
+            (str(r),): n for r, n in (await reviewer_backlogs()).items()
+        }, ("reviewer",))
+    except PyMongoError as e:
+        logging.warning("Metrics query failed: %s", e)
+
+    out += gauge("bot_scheduler_jobs_total", "Scheduler job totals", {
+        ("done",): scheduler_stats["jobs"] - scheduler_stats["failed"],
+        ("failed",): scheduler_stats["failed"]
+    }, ("result",), "counter")
+    out += gauge("bot_outbound_queue", "Requests waiting for a send token", {(): outbound.stats["queued"]})
+    out += gauge("bot_outbound_requests_total", "Outbound queue totals", {
+        ("sent",): outbound.stats["sent"],
+        ("retries",): outbound.stats["retries"],
+        ("errors",): outbound.stats["errors"]
+    }, ("kind",), "counter")
+
+    st = settings_cache_stats()
+    caches = {
+        "settings": st, "qr": qr_cache.stats(),
+        "verified_users": verified_users.stats(), "catalog": catalog_cache.stats()
+    }
+    out += gauge("bot_cache_hits_total", "Cache hits", {(k,): v["hits"] for k, v in caches.items()}, ("cache",), "counter")
+    out += gauge("bot_cache_misses_total", "Cache misses", {(k,): v["misses"] for k, v in caches.items()}, ("cache",), "counter")
+    out += gauge("bot_cache_size", "Cache entries", {
+        ("qr",): len(qr_cache), ("verified_users",): len(verified_users),
+        ("catalog",): len(catalog_cache)
+    }, ("cache",))
+    out += gauge("bot_settings_version", "Cached settings version", {(): st["version"]})
+    out += gauge("bot_updates_in_flight", "Updates running or waiting for a slot", {
+        ("running",): update_ordering.stats["active"],
+        ("waiting",): update_ordering.stats["waiting"]
+    }, ("state",))
+    out += gauge("bot_update_busy_keys", "Users/chats with updates in flight", {(): len(update_ordering.keys)})
+    out += gauge("bot_loop_lag_seconds_last", "Last sampled event loop lag", {(): loop_stats["lag"]})
+
+    return web.Response(text="\n".join(out) + "\n", content_type="text/plain", charset="utf-8")
+
+async def slow_log(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.json_response(list(slow_updates), dumps=lambda o: json.dumps(o, default=str))
+
+async def reconcile_upload(request):
+    if not RECONCILE_TOKEN or request.headers.get("Authorization") != f"Bearer {RECONCILE_TOKEN}":
+        return web.Response(status=401)
+
+    # raw CSV body, or the first part of a multipart form
+    if request.content_type.startswith("multipart/"):
+        part = await (await request.multipart()).next()
+        if part is None:
+            return web.json_response({"error": "empty form"}, status=400)
+        read = part.read_chunk
+    else:
+        read = lambda: request.content.read(65536)
+
+    with tempfile.TemporaryFile() as f:
+        while chunk := await read():
+            f.write(chunk)
+        f.seek(0)
+        report = await reconcile_file(f, 0)
+    return web.json_response(report, status=400 if "error" in report else 200)
+
 async def start_web():
     app = web.Application()
     app.router.add_get("/", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/debug/slow", slow_log)
+    app.router.add_post("/reconcile", reconcile_upload)
+
+    if BOT_MODE == "webhook":
+        # answer Telegram right away, handlers run as background tasks
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
@@ -114,34 +2010,34 @@ async def start_web():
 
 @dp.message(CommandStart())
 async def start_cmd(m: types.Message, state: FSMContext):
-    user = await users_col.find_one({"user_id": m.from_user.id})
-
-    # NEW USER → PASSCODE REQUIRED
-    if not user or not user.get("verified"):
-        await state.set_state(UserState.waiting_for_passcode)
-        return await m.answer(
-            "🔐 Access Protected\n\nPlease enter the bot passcode:"
+    # verified once → verified forever, skip the lookup
+    if not verified_users.get(m.from_user.id):
+        user = await users_col.find_one(
+            {"user_id": m.from_user.id},
+            {"verified": 1, "blocked": 1}
         )
 
-    # VERIFIED USER MENU
-    kb = [
-        [
-            types.KeyboardButton(text="💎 Buy VIP Membership"),
-            types.KeyboardButton(text="❓ Help")
-        ]
-    ]
+        # NEW USER → PASSCODE REQUIRED
+        if not user or not user.get("verified"):
+            await state.set_state(UserState.waiting_for_passcode)
+            return await m.answer(
+                "🔐 Access Protected\n\nPlease enter the bot passcode:"
+            )
+
+        # came back after blocking the bot → include in broadcasts again
+        if user.get("blocked"):
+            await users_col.update_one(
+                {"user_id": m.from_user.id},
+                {"$unset": {"blocked": ""}}
+            )
 
-    # ADMIN EXTRA BUTTON
-    if m.from_user.id == ADMIN_ID:
-        kb.append([types.KeyboardButton(text="⚙️ Admin Panel")])
+        verified_users.set(m.from_user.id, True)
 
+    # VERIFIED USER MENU (+ admin button for the admin)
     await m.answer_photo(
         photo=WELCOME_IMAGE,
         caption="👋 Welcome to the Premium Bot!",
-        reply_markup=types.ReplyKeyboardMarkup(
-            keyboard=kb,
-            resize_keyboard=True
-        )
+        reply_markup=main_menu_kb(m.from_user.id)
     )
 
 @dp.message(UserState.waiting_for_passcode)
@@ -161,34 +2057,20 @@ async def check_passcode(m: types.Message, state: FSMContext):
     },
     upsert=True
     )
+    verified_users.set(m.from_user.id, True)
 
     await state.clear()
 
-    kb = [
-        [
-            types.KeyboardButton(text="💎 Buy VIP Membership"),
-            types.KeyboardButton(text="❓ Help")
-        ]
-    ]
-
     await m.answer_photo(
         photo=WELCOME_IMAGE,
         caption="✅ *Access Granted!*\n\nWelcome to the Premium Bot 🎉",
         parse_mode="Markdown",
-        reply_markup=types.ReplyKeyboardMarkup(
-            keyboard=kb,
-            resize_keyboard=True
-        )
+        reply_markup=main_menu_kb(m.from_user.id)
     )
 
 @dp.message(F.text == "💎 Buy VIP Membership")
 async def show_categories(m: types.Message):
-    s = await get_settings()
-    kb = InlineKeyboardBuilder()
-    for k, v in s["categories"].items():
-        kb.button(text=f"{v['name']} ({v['price']})", callback_data=f"cat_{k}")
-    kb.adjust(1)
-    await m.answer("Select category:", reply_markup=kb.as_markup())
+    await m.answer("Select category:", reply_markup=await cached_markup("categories", True))
 
 @dp.message(F.text == "❓ Help")
 async def help_start(m: types.Message, state: FSMContext):
@@ -201,22 +2083,13 @@ async def help_start(m: types.Message, state: FSMContext):
 
 @dp.message(F.text == "⚙️ Admin Panel")
 async def admin_panel(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
 
-    kb = [
-        [types.KeyboardButton(text="👥 Users")],
-        [types.KeyboardButton(text="💰 Manage Categories")],
-        [types.KeyboardButton(text="📢 Force Subscribe")],
-        [types.KeyboardButton(text="⬅️ Back")]
-    ]
-
     await m.answer(
         "⚙️ *Admin Panel*",
         parse_mode="Markdown",
-        reply_markup=types.ReplyKeyboardMarkup(
-            keyboard=kb, resize_keyboard=True
-        )
+        reply_markup=ADMIN_PANEL_KB
     )
     
 @dp.message(UserState.waiting_for_help)
@@ -230,27 +2103,29 @@ async def send_help_to_admin(m: types.Message, state: FSMContext):
         "📩 Message:"
     )
 
+    reviewer = await pick_reviewer()
     if m.photo:
         await bot.send_photo(
-            ADMIN_ID,
+            reviewer,
             m.photo[-1].file_id,
             caption=f"{header}",
             parse_mode="Markdown"
         )
     else:
         await bot.send_message(
-            ADMIN_ID,
+            reviewer,
             f"{header}\n{m.text}",
             parse_mode="Markdown"
         )
 
     await m.answer("✅ Message admin ko bhej diya gaya hai.\nPlease wait for reply ⏳")
 
-@dp.message(F.reply_to_message, F.from_user.id == ADMIN_ID)
+@dp.message(F.reply_to_message, F.from_user.id.in_(set(REVIEWER_IDS) | set(ADMIN_IDS)))
 async def admin_reply_to_user(m: types.Message):
     original = m.reply_to_message.text or m.reply_to_message.caption
+    # not a reply to a help request (e.g. /broadcast as a reply)
     if not original or "User ID:" not in original:
-        return
+        raise SkipHandler()
 
     try:
         user_id = int(original.split("User ID:")[1].split()[0].replace("`", ""))
@@ -265,69 +2140,40 @@ async def admin_reply_to_user(m: types.Message):
 
 @dp.message(F.text == "⬅️ Back")
 async def back_btn(m: types.Message):
-    kb = [
-        [
-            types.KeyboardButton(text="💎 Buy VIP Membership"),
-            types.KeyboardButton(text="❓ Help")
-        ]
-    ]
-    if m.from_user.id == ADMIN_ID:
-        kb.append([types.KeyboardButton(text="⚙️ Admin Panel")])
-
     await m.answer(
         "⬅️ Back to main menu",
-        reply_markup=types.ReplyKeyboardMarkup(
-            keyboard=kb, resize_keyboard=True
-        )
+        reply_markup=main_menu_kb(m.from_user.id)
     )
 
 
 @dp.callback_query(F.data.startswith("cat_"))
 async def select_category(c: types.CallbackQuery, state: FSMContext):
     cat_key = c.data.split("_", 1)[1]
-    settings = await get_settings()
-    category = settings["categories"].get(cat_key)
+    category, plans = await asyncio.gather(get_category(cat_key), get_plans(cat_key))
 
     if not category:
         return await c.answer("Category not found", show_alert=True)
 
-    plans = category.get("plans")
     if not plans:
         return await c.answer("No plans available. Contact admin.", show_alert=True)
 
     await state.update_data(category=cat_key)
     await state.set_state(UserState.selecting_plan)
 
-    kb = InlineKeyboardBuilder()
-    for plan_id, plan in plans.items():
-        kb.button(
-            text=f"{category['name']} – {plan['label']} – {plan['price']}",
-            callback_data=f"plan_{plan_id}"
-        )
-
-    kb.button(text="⬅️ Back", callback_data="back_to_categories")
-    kb.adjust(1)
-
     await c.message.edit_text(
         f"📦 *Select a Plan for {category['name']}*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("plans", cat_key)
     )
 
 @dp.callback_query(F.data == "back_to_categories")
 async def back_to_categories(c: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    settings = await get_settings()
-
-    kb = InlineKeyboardBuilder()
-    for key, data in settings["categories"].items():
-        kb.button(text=data["name"], callback_data=f"cat_{key}")
-    kb.adjust(1)
 
     await c.message.edit_text(
         "✨ *Select a VIP Category:*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("categories", False)
     )
 
 #plan working with inline button 
@@ -338,11 +2184,9 @@ async def select_plan(c: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     cat_key = data.get("category")
 
-    settings = await get_settings()
-    category = settings["categories"].get(cat_key)
-    plan = category["plans"].get(plan_id)
+    category, plan = await asyncio.gather(get_category(cat_key), get_plan(cat_key, plan_id))
 
-    if not plan:
+    if not category or not plan:
         return await c.answer("Plan not found", show_alert=True)
 
     # Save selected plan
@@ -387,29 +2231,192 @@ async def proceed_payment(c: types.CallbackQuery, state: FSMContext):
     if not cat or not plan_id:
         return await c.answer("Session expired. Please try again.", show_alert=True)
 
-    settings = await get_settings()
-    category = settings["categories"][cat]
-    plan = category["plans"][plan_id]
-
-    qr = generate_upi_qr(settings["upi_id"])
+    settings, category, plan = await asyncio.gather(
+        get_settings(), get_category(cat), get_plan(cat, plan_id)
+    )
+    if not category or not plan:
+        return await c.answer("Plan not found", show_alert=True)
 
-    await c.message.answer_photo(
-        types.BufferedInputFile(qr.getvalue(), "upi.png"),
+    # pre-rendered at plan save time; plans saved before that (or a changed
+    # UPI id / UPI_AMOUNT_TAGS) fall back to the shared QR cache
+    amount = parse_amount(plan["price"])
+    tagged = bool(UPI_AMOUNT_TAGS and amount)
+    variants = [plan.get("qr") or {}]
+    if tagged:
+        # UPI apps drop the note but keep the amount: a random paise tag
+        # narrows a statement credit down to a few orders for the reviewer.
+        # Tags are not unique, they never approve anything on their own.
+        tag = secrets.randbelow(UPI_AMOUNT_TAGS) + 1
+        amount = tagged_amount(amount, tag)
+        variants = (plan.get("qr") or {}).get("tags") or []
+        variants = variants[tag - 1:tag]
+    uri = plan_upi_uri(settings["upi_id"], cat, plan_id, plan, amount)
+    qr = next((v for v in variants if v.get("uri") == uri), None) or await get_upi_qr(uri)
+
+    # the QR is shared, the order reference only goes in the caption
+    order_ref = new_order_ref()
+    await state.update_data(order_ref=order_ref, pay_plan_id=plan_id, pay_amount=amount, amount_tagged=tagged)
+    pay_line = f"💸 Pay exactly: ₹{amount}\n" if tagged else ""
+
+    sent = await c.message.answer_photo(
+        qr_photo(qr),
         caption=(
             "💳 *Payment Instructions*\n\n"
             f"📂 Category: {category['name']}\n"
             f"📦 Plan: {plan['label']}\n"
-            f"💰 Price: {plan['price']}\n\n"
-            "✅ Pay via UPI\n"
+            f"💰 Price: {plan['price']}\n"
+            f"{pay_line}"
+            f"🔖 Reference: `{order_ref}`\n\n"
+            "✅ Pay via UPI (add the reference in the payment note)\n"
             "📸 Then send *payment screenshot / proof* here"
         ),
         parse_mode="Markdown"
     )
 
+    # reuse the uploaded photo next time instead of sending the bytes again
+    if not qr.get("file_id"):
+        qr["file_id"] = sent.photo[-1].file_id
+
     await state.set_state(UserState.waiting_for_proof)
     await c.answer()
 
 # ================= PROOF =================
+# Every photo proof gets a 256-bit dHash, computed in the executor from a
+# mid-sized rendition. The hash is split into PROOF_HASH_BANDS bands stored
+# as a multikey array: two hashes within BANDS-1 bits share at least one
+# band exactly, so a lookup only compares the proofs in the same buckets,
+# the newest PROOF_HASH_CANDIDATES of each. Resends of the very same file are
+# found by file_unique_id, however crowded the buckets are.
+PROOF_HASH_BITS = 256
+PROOF_HASH_SIDE = 16
+
+def dhash(data):
+    with Image.open(io.BytesIO(data)) as img:
+        w, h = img.size
+        # status and navigation bars are the same on every phone screenshot
+        img = img.convert("L").crop((0, h // 10, w, h - h // 10))
+        pixels = list(img.resize((PROOF_HASH_SIDE + 1, PROOF_HASH_SIDE), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(PROOF_HASH_SIDE):
+        for col in range(PROOF_HASH_SIDE):
+            i = row * (PROOF_HASH_SIDE + 1) + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return value
+
+def hash_bands(value):
+    # (band index << 32) | band bits, so equal bits in different bands differ
+    bands, start = [], 0
+    for i in range(PROOF_HASH_BANDS):
+        width = (PROOF_HASH_BITS - start) // (PROOF_HASH_BANDS - i)
+        bands.append(i << 32 | (value >> start) & ((1 << width) - 1))
+        start += width
+    return bands
+
+def proof_size(photo_sizes):
+    # dHash only needs 17x16 pixels, skip downloading the full resolution
+    return next((p for p in photo_sizes if min(p.width, p.height) >= 256), photo_sizes[-1])
+
+PROOF_FIELDS = {"hash": 1, "bits": 1, "file_unique_id": 1, "order_id": 1, "ref": 1, "user_id": 1}
+
+def proof_duplicate(other, distance, same_file):
+    return {
+        "order_id": other["order_id"],
+        "ref": other["ref"],
+        "user_id": other["user_id"],
+        "distance": distance,
+        "same_file": same_file
+    }
+
+async def check_proof_duplicates(photo_sizes, order):
+    photo = proof_size(photo_sizes)
+    # the latest earlier proofs with this file, whatever their hash version
+    same = await proof_hashes_col.find(
+        {"file_unique_id": photo.file_unique_id}, PROOF_FIELDS
+    ).sort("created_at", -1).limit(PROOF_HASH_CANDIDATES).to_list(None)
+    known = next((p for p in same if p.get("bits") == PROOF_HASH_BITS), None)
+    if known:
+        value = int(known["hash"], 16)
+    else:
+        buf = io.BytesIO()
+        await bot.download(photo.file_id, destination=buf)
+        loop = asyncio.get_running_loop()
+        value = await loop.run_in_executor(None, dhash, buf.getvalue())
+
+    bands = hash_bands(value)
+    # 64-bit hashes from before the switch to 256 bits have no "bits" field
+    buckets = await asyncio.gather(*(
+        proof_hashes_col.find({"bands": band, "bits": PROOF_HASH_BITS}, PROOF_FIELDS)
+        .sort("created_at", -1).limit(PROOF_HASH_CANDIDATES).to_list(None)
+        for band in bands
+    ))
+    seen = {p["_id"] for p in same}
+    near = []
+    for other in itertools.chain.from_iterable(buckets):
+        if other["_id"] in seen:
+            continue
+        seen.add(other["_id"])
+        distance = bin(value ^ int(other["hash"], 16)).count("1")
+        if distance <= PROOF_HASH_DISTANCE:
+            near.append(proof_duplicate(other, distance, False))
+
+    record = {
+        "hash": f"{value:064x}",
+        "bits": PROOF_HASH_BITS,
+        "bands": bands,
+        "file_unique_id": photo.file_unique_id,
+        "order_id": order["_id"],
+        "ref": order["ref"],
+        "user_id": order["user_id"],
+        "created_at": datetime.utcnow()
+    }
+    near.sort(key=lambda d: d["distance"])
+    # the caller stores `record` once the order itself is saved
+    return [proof_duplicate(p, 0, True) for p in same] + near[:5], record
+
+def order_caption(order):
+    caption = (
+        "🧾 *Payment Proof*\n\n"
+        f"👤 User: {order['user_name']}\n"
+        f"🆔 ID: `{order['user_id']}`\n"
+        f"📂 Category: `{order['category']}`\n"
+        f"📦 Plan: `{order['plan_label']}` – {order['price']}\n"
+        f"🔖 Ref: `{order['ref']}`"
+    )
+    duplicates = order.get("duplicate_of") or []
+    for d in duplicates[:5]:
+        same = "same user" if d["user_id"] == order["user_id"] else f"user `{d['user_id']}`"
+        # only the very same Telegram file is certain, equal hashes may still differ
+        kind = "identical" if d.get("same_file") else f"{d['distance']} bits apart"
+        caption += f"\n⚠️ Possible duplicate of Ref `{d['ref']}` ({same}, {kind})"
+    if len(duplicates) > 5:
+        # captions are capped at 1024 characters
+        caption += f"\n⚠️ …and {len(duplicates) - 5} more"
+    return caption
+
+async def send_order_card(order, chat_id, with_buttons=True):
+    kb = None
+    if with_buttons:
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✅ Approve", callback_data=f"approve_{order['_id']}"),
+            InlineKeyboardButton(text="❌ Reject", callback_data=f"reject_{order['_id']}")
+        ]])
+
+    proof = order["proof"]
+    if proof["kind"] == "photo":
+        return await bot.send_photo(
+            chat_id,
+            proof["file_id"],
+            caption=order_caption(order),
+            parse_mode="Markdown",
+            reply_markup=kb
+        )
+    return await bot.send_message(
+        chat_id,
+        order_caption(order) + f"\n\n📄 Message:\n{proof['text']}",
+        parse_mode="Markdown",
+        reply_markup=kb
+    )
+
 @dp.message(UserState.waiting_for_proof)
 async def receive_proof(m: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -421,111 +2428,236 @@ async def receive_proof(m: types.Message, state: FSMContext):
     if not cat or not plan_id:
         return await m.answer("❌ Session expired. Please try again.")
 
-    admin_kb = types.InlineKeyboardMarkup(inline_keyboard=[[
-        types.InlineKeyboardButton(
-            text="✅ Approve",
-            callback_data=f"approve_{m.from_user.id}_{cat}_{plan_id}"
-        ),
-        types.InlineKeyboardButton(
-            text="❌ Reject",
-            callback_data=f"reject_{m.from_user.id}"
-        )
-    ]])
-
-    caption = (
-        "🧾 *Payment Proof*\n\n"
-        f"👤 User: {m.from_user.full_name}\n"
-        f"🆔 ID: `{m.from_user.id}`\n"
-        f"📂 Category: `{cat}`\n"
-        f"📦 Plan: `{plan_id}`"
-    )
+    category, plan = await asyncio.gather(get_category(cat), get_plan(cat, plan_id))
+    if not category or not plan:
+        return await m.answer("❌ This plan is no longer available. Please choose again.")
 
     if m.photo:
-        await bot.send_photo(
-            ADMIN_ID,
-            m.photo[-1].file_id,
-            caption=caption,
-            parse_mode="Markdown",
-            reply_markup=admin_kb
-        )
+        proof = {"kind": "photo", "file_id": m.photo[-1].file_id}
     else:
-        await bot.send_message(
-            ADMIN_ID,
-            caption + f"\n\n📄 Message:\n{m.text}",
-            parse_mode="Markdown",
-            reply_markup=admin_kb
-        )
+        proof = {"kind": "text", "text": m.text or m.caption or ""}
+
+    # the amount shown at checkout, unless the plan was switched since
+    shown = data.get("pay_plan_id") == plan_id and data.get("pay_amount")
+
+    order = {
+        "ref": data.get("order_ref") or new_order_ref(),
+        "user_id": m.from_user.id,
+        "user_name": m.from_user.full_name,
+        "username": m.from_user.username,
+        "category": cat,
+        "category_name": category["name"],
+        "plan_id": plan_id,
+        "plan_label": plan["label"],
+        "price": plan["price"],
+        "amount": data["pay_amount"] if shown else parse_amount(plan["price"]),
+        "amount_tagged": bool(shown and data.get("amount_tagged")),
+        "proof": proof,
+        "status": "pending",
+        "assigned_to": await pick_reviewer(),
+        "created_at": datetime.utcnow()
+    }
+    order["_id"] = ObjectId()
+
+    # flag re-used screenshots before anyone reviews the card
+    proof_hash = None
+    if m.photo:
+        try:
+            order["duplicate_of"], proof_hash = await check_proof_duplicates(m.photo, order)
+        except (TelegramAPIError, PyMongoError, OSError) as e:
+            logging.warning("Proof hash for order %s failed: %s", order["_id"], e)
+
+    await orders_col.insert_one(order)
+    # only now: a hash without its order would flag the user's retry
+    if proof_hash:
+        try:
+            await proof_hashes_col.insert_one(proof_hash)
+        except PyMongoError as e:
+            logging.warning("Proof hash for order %s not saved: %s", order["_id"], e)
+
+    card = await send_order_card(order, order["assigned_to"])
+    await orders_col.update_one(
+        {"_id": order["_id"]},
+        {"$set": {"admin_message": {"chat_id": card.chat.id, "message_id": card.message_id}}}
+    )
 
     await m.answer("✅ Proof sent to admin. Please wait for approval.")
     
 # ================= ADMIN ACTIONS =================
 
-@dp.callback_query(F.data.startswith("approve_"))
-async def admin_approve(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        return
-
-    _, uid, cat, plan_id = c.data.split("_")
-    uid = int(uid)
-
-    settings = await get_settings()
-    category = settings["categories"].get(cat)
-    plan = category["plans"].get(plan_id)
-
-    days = plan["days"]
-    purchase_date = datetime.utcnow()
-    expires_at = purchase_date + timedelta(days=days)
+def approval_applied(sub, key):
+    return bool(sub) and (
+        sub.get("approval_key") == key
+        or any(h.get("approval_key") == key for h in sub.get("history") or [])
+    )
 
-    # Save subscription
-    await subs_col.insert_one({
-        "user_id": uid,
-        "category": cat,
-        "plan_id": plan_id,
-        "expires_at": expires_at,
-        "reminder_sent": False,
-        "status": "active"
-    })
+async def extend_subscription(uid, cat, plan_id, days, key):
+    # Stack the plan onto the user's single subscription for this category:
+    # expires_at = max(now, expires_at) + days, the previous period goes to
+    # history. Skipped when this approval_key was already applied (retry,
+    # or a second claim of a stuck approval): approvals_col records every
+    # applied key for good, and the filter below checks the current and
+    # recent keys atomically with the update, for a crash before recording.
+    if await approvals_col.count_documents({"_id": key}, limit=1):
+        return await subs_col.find_one({"user_id": uid, "category": cat})
+
+    now = datetime.utcnow()
+    previous = {
+        "plan_id": "$plan_id",
+        "approved_at": "$approved_at",
+        "expires_at": "$expires_at",
+        "approval_key": "$approval_key"
+    }
+    pipeline = [
+        {"$set": {
+            "history": {"$slice": [
+                {"$concatArrays": [
+                    {"$ifNull": ["$history", []]},
+                    {"$cond": [{"$gt": ["$expires_at", None]}, [previous], []]}
+                ]},
+                -SUB_HISTORY_SIZE
+            ]}
+        }},
+        {"$set": {
+            "expires_at": {"$add": [
+                {"$max": [now, {"$ifNull": ["$expires_at", now]}]},
+                days * 86400 * 1000
+            ]},
+            "plan_id": plan_id,
+            "approved_at": now,
+            "approval_key": key,
+            "status": "active",
+            "reminder_sent": False
+        }},
+        # a scheduler pass that expired the row must not kick the user now
+        {"$project": {"expired_by": 0}}
+    ]
 
-    # Try to add user
-    added = False
-    invite_text = "Access granted automatically"
+    for _ in range(3):
+        try:
+            sub = await subs_col.find_one_and_update(
+                {
+                    "user_id": uid,
+                    "category": cat,
+                    "approval_key": {"$ne": key},
+                    "history.approval_key": {"$ne": key}
+                },
+                pipeline,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # either already applied, or a concurrent first approval won the insert
+            sub = await subs_col.find_one({"user_id": uid, "category": cat})
+            if approval_applied(sub, key):
+                break
+    else:
+        raise RuntimeError(f"Could not extend subscription {uid}/{cat}")
 
     try:
-        if category.get("channel_id"):
-            await bot.add_chat_members(category["channel_id"], uid)
-            added = True
-
-        if category.get("group_id"):
-            await bot.add_chat_members(category["group_id"], uid)
-            added = True
-    except:
+        await approvals_col.insert_one({
+            "_id": key, "user_id": uid, "category": cat, "plan_id": plan_id,
+            "days": days, "applied_at": now
+        })
+    except DuplicateKeyError:
         pass
+    return sub
+
+async def save_approved_subscription(uid, cat, plan_id, days, key):
+    sub = await extend_subscription(uid, cat, plan_id, days, key)
+    await schedule_subscription_jobs(sub)
+    return sub
+
+async def create_invite_links(category):
+    # the Bot API cannot add users to chats, single-use invite links it is
+    targets = [
+        (label, category[field])
+        for label, field in (("📢 Channel", "channel_id"), ("👥 Group", "group_id"))
+        if category.get(field)
+    ]
+    links = await asyncio.gather(
+        *(bot.create_chat_invite_link(chat_id, member_limit=1) for _, chat_id in targets)
+    )
+    return [(label, link.invite_link) for (label, _), link in zip(targets, links)]
 
-    # Privacy fallback → invite
-    if not added:
-        if category.get("channel_id"):
-            link = await bot.create_chat_invite_link(category["channel_id"], member_limit=1)
-            invite_text = link.invite_link
-            await bot.send_message(uid, f"🔗 Join Channel:\n{invite_text}")
+async def edit_order_card(order, text):
+    msg = order.get("admin_message")
+    if not msg:
+        return
+    if order["proof"]["kind"] == "photo":
+        await bot.edit_message_caption(chat_id=msg["chat_id"], message_id=msg["message_id"], caption=text)
+    else:
+        await bot.edit_message_text(text=text, chat_id=msg["chat_id"], message_id=msg["message_id"])
+
+async def claim_order(order_id, admin_id):
+    # pending → approving, so two taps / two reviewers never both approve
+    now = datetime.utcnow()
+    return await orders_col.find_one_and_update(
+        {
+            "_id": order_id,
+            "$or": [
+                {"status": "pending"},
+                {"status": "approving", "claimed_at": {"$lt": now - timedelta(seconds=ORDER_CLAIM_TIMEOUT)}}
+            ]
+        },
+        {"$set": {"status": "approving", "reviewed_by": admin_id, "claimed_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
 
-        if category.get("group_id"):
-            link = await bot.create_chat_invite_link(category["group_id"], member_limit=1)
-            invite_text = link.invite_link
-            await bot.send_message(uid, f"🔗 Join Group:\n{invite_text}")
+async def approve_order(order_id, admin_id):
+    # None when someone else already handled the order
+    order = await claim_order(order_id, admin_id)
+    if not order:
+        return None
 
-    # Extract purchaser name SAFELY
-    user_name = "Unknown User"
+    uid, cat, plan_id = order["user_id"], order["category"], order["plan_id"]
     try:
-        if c.message.caption and "User:" in c.message.caption:
-            user_name = c.message.caption.split("User:")[1].splitlines()[0].strip()
-    except:
-        pass
+        category, plan = await asyncio.gather(get_category(cat), get_plan(cat, plan_id))
+        if not category or not plan:
+            raise RuntimeError(f"plan {cat}/{plan_id} no longer exists")
+
+        days = plan["days"]
+        purchase_date = datetime.utcnow()
+
+        # Mongo write and invite links don't depend on each other
+        sub, links = await asyncio.gather(
+            save_approved_subscription(uid, cat, plan_id, days, str(order["_id"])),
+            create_invite_links(category),
+            return_exceptions=True
+        )
+        if isinstance(sub, BaseException):
+            raise sub
+    except Exception:
+        # nothing was granted: back to the queue so it can be approved again
+        await orders_col.update_one(
+            {"_id": order["_id"], "status": "approving"},
+            {"$set": {"status": "pending"}, "$unset": {"claimed_at": "", "reviewed_by": ""}}
+        )
+        raise
+
+    if isinstance(links, BaseException):
+        # the subscription is extended, so the order must not be pending
+        # (or rejectable) again; it stays "approving" with a lapsed claim,
+        # and the next tap only retries the links, the approval key keeps
+        # the days from being added twice
+        await orders_col.update_one(
+            {"_id": order["_id"], "status": "approving"},
+            {"$set": {"claimed_at": datetime.utcnow() - timedelta(seconds=ORDER_CLAIM_TIMEOUT + 1)}}
+        )
+        raise links
+    expires_at = sub["expires_at"]
+
+    if links:
+        invite_text = "\n" + "\n".join(f"{label}: {url}" for label, url in links)
+    else:
+        invite_text = "Access granted automatically"
 
     # VIP RECEIPT
     receipt = (
         "🧾 <b>VIP SUBSCRIPTION RECEIPT</b>\n"
         "━━━━━━━━━━━━━━━━━━━━\n"
-        f"👤 <b>Purchaser:</b> {user_name}\n"
+        f"👤 <b>Purchaser:</b> {html.escape(order.get('user_name') or 'Unknown User')}\n"
         f"🆔 <b>User ID:</b> {uid}\n"
         f"📂 <b>Category:</b> {category['name']}\n"
         f"🔹 <b>Plan:</b> {plan['label']}\n"
@@ -539,86 +2671,257 @@ async def admin_approve(c: types.CallbackQuery):
         f"👉 <b>Your VIP Link:</b> {invite_text}"
     )
 
-    await bot.send_message(uid, receipt, parse_mode="HTML")
-    await c.message.edit_caption("✅ Approved & VIP Activated")
-    
+    sent, edited = await asyncio.gather(
+        bot.send_message(uid, receipt, parse_mode="HTML"),
+        edit_order_card(order, "✅ Approved & VIP Activated"),
+        return_exceptions=True
+    )
+    if isinstance(edited, Exception):
+        logging.warning("Order %s: card edit failed: %s", order["_id"], edited)
+    if isinstance(sent, Exception):
+        logging.warning("Order %s: receipt to %s failed: %s", order["_id"], uid, sent)
+
+    await orders_col.update_one({"_id": order["_id"]}, {"$set": {
+        "status": "approved",
+        "links": [url for _, url in links],
+        "receipt_sent": not isinstance(sent, Exception),
+        "expires_at": expires_at,
+        "reviewed_at": datetime.utcnow()
+    }})
+    return order
+
+async def reject_order(order_id, admin_id):
+    order = await orders_col.find_one_and_update(
+        {"_id": order_id, "status": "pending"},
+        {"$set": {"status": "rejected", "reviewed_by": admin_id, "reviewed_at": datetime.utcnow()}}
+    )
+    if not order:
+        return None
+
+    results = await asyncio.gather(
+        bot.send_message(order["user_id"], "❌ Payment rejected"),
+        edit_order_card(order, "❌ Rejected"),
+        return_exceptions=True
+    )
+    for r in results:
+        if isinstance(r, Exception):
+            logging.warning("Order %s: reject notice failed: %s", order["_id"], r)
+    return order
+
+async def legacy_order(c):
+    # cards sent before the orders collection carry approve_{uid}_{cat}_{plan}
+    uid, cat, plan_id = c.data.split("_", 1)[1].split("_")
+    category, plan = await asyncio.gather(get_category(cat), get_plan(cat, plan_id))
+
+    user_name = "Unknown User"
+    if c.message.caption and "User:" in c.message.caption:
+        user_name = c.message.caption.split("User:")[1].splitlines()[0].strip()
+
+    order = await orders_col.find_one_and_update(
+        {"legacy_key": f"{c.message.chat.id}:{c.message.message_id}"},
+        {"$setOnInsert": {
+            "ref": new_order_ref(),
+            "user_id": int(uid),
+            "user_name": user_name,
+            "category": cat,
+            "category_name": category["name"] if category else cat,
+            "plan_id": plan_id,
+            "plan_label": plan["label"] if plan else plan_id,
+            "price": plan["price"] if plan else "-",
+            "amount": parse_amount(plan["price"]) if plan else None,
+            "proof": {"kind": "photo" if c.message.photo else "text"},
+            "admin_message": {"chat_id": c.message.chat.id, "message_id": c.message.message_id},
+            "status": "pending",
+            "created_at": datetime.utcnow()
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return order["_id"]
+
+async def order_status_text(order_id):
+    order = await orders_col.find_one({"_id": order_id}, {"status": 1})
+    return {
+        "approved": "✅ Already approved",
+        "rejected": "❌ Already rejected",
+        "approving": "⏳ Approval in progress"
+    }.get(order and order["status"], "Order not found")
+
+@dp.callback_query(F.data.startswith("approve_"))
+async def admin_approve(c: types.CallbackQuery):
+    if not is_reviewer(c.from_user.id):
+        return
+
+    arg = c.data.split("_", 1)[1]
+    order_id = ObjectId(arg) if ObjectId.is_valid(arg) else await legacy_order(c)
+
+    try:
+        order = await approve_order(order_id, c.from_user.id)
+    except Exception:
+        await c.answer("❌ Approval failed, try again", show_alert=True)
+        raise
+
+    if not order:
+        return await c.answer(await order_status_text(order_id))
+    await c.answer("✅ Approved")
+
 @dp.callback_query(F.data.startswith("reject_"))
 async def reject(c: types.CallbackQuery):
-    uid = c.data.split("_")[1]
-    await bot.send_message(int(uid), "❌ Payment rejected")
-    await c.message.edit_caption("❌ Rejected")
+    if not is_reviewer(c.from_user.id):
+        return
+
+    arg = c.data.split("_", 1)[1]
+    if not ObjectId.is_valid(arg):
+        # legacy card: reject_{uid}
+        await bot.send_message(int(arg), "❌ Payment rejected")
+        return await c.message.edit_caption(caption="❌ Rejected")
+
+    order = await reject_order(ObjectId(arg), c.from_user.id)
+    await c.answer("❌ Rejected" if order else await order_status_text(ObjectId(arg)))
 
        #users#
 @dp.message(F.text == "👥 Users")
-async def admin_users(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+@dp.message(Command("users"))
+async def admin_users(m: types.Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
         return
 
-    cursor = users_col.find()
-    text = "👥 USERS LIST\n\n"
+    # /users <username or id prefix>
+    parts = (m.text or "").split(maxsplit=1)
+    search = parts[1].strip() if m.text.startswith("/") and len(parts) > 1 else None
+    if search and users_search_query(search) is None:
+        return await m.answer(f"❌ User IDs have at most {USER_ID_DIGITS} digits.")
+    await state.update_data(users_search=search)
 
-    async for u in cursor:
-        text += (
-            f"Name: {u.get('username', 'N/A')}\n"
-            f"User ID: {u['user_id']}\n"
-            f"Joined: {u.get('joined_at', 'N/A')}\n\n"
-        )
+    text, kb = await render_users_page(search)
+    await m.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("users_"))
+async def admin_users_page(c: types.CallbackQuery, state: FSMContext):
+    if not is_admin(c.from_user.id):
+        return
 
-        # avoid message too long
-        if len(text) > 3500:
-            await m.answer(text)
-            text = ""
+    _, direction, uid = c.data.split("_")
+    search = (await state.get_data()).get("users_search")
+    if direction == "n":
+        text, kb = await render_users_page(search, after=int(uid))
+    else:
+        text, kb = await render_users_page(search, before=int(uid))
 
-    if text:
-        await m.answer(text)
+    await c.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await c.answer()
 
-    await m.answer(
-        "✉️ Send message:\n"
-        "/msg user_id your message\n"
-        "/msg @username your message"
-    )
+#review queue
+async def show_queue_page(c, state, cursor=None, keep_cursor=True):
+    data = await state.get_data()
+    if keep_cursor:
+        cursor = data.get("queue_cursor")
+    await state.update_data(queue_cursor=cursor)
 
-#manage category 
-@dp.message(F.text == "💰 Manage Categories")
-async def admin_manage_categories(m: types.Message, state: FSMContext):
-    if m.from_user.id != ADMIN_ID:
+    selected = set(data.get("queue_selected") or [])
+    text, kb, _ = await render_queue_page(selected, cursor, queue_scope(c.from_user.id))
+    try:
+        await c.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    except TelegramAPIError:
+        pass  # "message is not modified"
+
+@dp.message(F.text == "🧾 Review Queue")
+@dp.message(Command("queue"))
+async def admin_queue(m: types.Message, state: FSMContext):
+    if not is_reviewer(m.from_user.id):
         return
 
-    settings = await get_settings()
-    kb = InlineKeyboardBuilder()
+    await state.update_data(queue_cursor=None, queue_selected=[])
+    text, kb, _ = await render_queue_page(set(), reviewer=queue_scope(m.from_user.id))
+    await m.answer(text, parse_mode="HTML", reply_markup=kb)
 
-    for key, cat in settings["categories"].items():
-        kb.button(text=cat["name"], callback_data=f"admin_cat_{key}")
+@dp.callback_query(F.data.startswith("queue_"))
+async def admin_queue_action(c: types.CallbackQuery, state: FSMContext):
+    if not is_reviewer(c.from_user.id):
+        return
 
-    kb.adjust(1)
+    parts = c.data.split("_")
+    action, arg = parts[1], parts[2] if len(parts) > 2 else None
+    data = await state.get_data()
+    selected = set(data.get("queue_selected") or [])
+
+    if action == "v":
+        order = await orders_col.find_one({"_id": ObjectId(arg)})
+        if not order or not ("file_id" in order["proof"] or "text" in order["proof"]):
+            return await c.answer("Proof not available", show_alert=True)
+        await send_order_card(order, c.from_user.id, with_buttons=False)
+        return await c.answer()
+
+    if action == "n":
+        return await show_queue_page(c, state, arg, keep_cursor=False)
+    if action == "first":
+        return await show_queue_page(c, state, None, keep_cursor=False)
+
+    if action == "t":
+        selected ^= {arg}
+    elif action == "all":
+        _, _, page_ids = await render_queue_page(
+            selected, data.get("queue_cursor"), queue_scope(c.from_user.id)
+        )
+        selected |= set(page_ids)
+    elif action == "none":
+        selected = set()
+    elif action in ("ok", "no"):
+        if not selected:
+            return await c.answer("Nothing selected")
+        await c.answer("⏳ Working…")
+
+        run = approve_order if action == "ok" else reject_order
+        sem = asyncio.Semaphore(APPROVE_CONCURRENCY)
+
+        async def one(order_id):
+            async with sem:
+                return await run(ObjectId(order_id), c.from_user.id)
+
+        results = await asyncio.gather(*(one(i) for i in selected), return_exceptions=True)
+        done = sum(1 for r in results if r and not isinstance(r, Exception))
+        failed = [r for r in results if isinstance(r, Exception)]
+        skipped = len(results) - done - len(failed)
+        for e in failed:
+            logging.warning("Queue %s failed: %s", action, e)
+
+        selected = set()
+        verb = "approved" if action == "ok" else "rejected"
+        await c.message.answer(
+            f"✅ {done} {verb}"
+            + (f"\n⏭ {skipped} already handled" if skipped else "")
+            + (f"\n❌ {len(failed)} failed, still pending" if failed else "")
+        )
+
+    await state.update_data(queue_selected=list(selected))
+    await show_queue_page(c, state)
+    if action not in ("ok", "no"):
+        await c.answer()
+
+#manage category 
+@dp.message(F.text == "💰 Manage Categories")
+async def admin_manage_categories(m: types.Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
 
     await m.answer(
         "💰 *Select Category to Manage*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("admin_categories")
     )
 
 @dp.callback_query(F.data.startswith("admin_cat_"))
 async def admin_cat_actions(c: types.CallbackQuery, state: FSMContext):
-    if c.from_user.id != ADMIN_ID:
+    if not is_admin(c.from_user.id):
         return
 
     cat_key = c.data.split("_", 2)[2]
     await state.update_data(admin_category=cat_key)
 
-    kb = InlineKeyboardBuilder()
-    kb.button(text="➕ Add Plan", callback_data="admin_add_plan")
-    kb.button(text="✏️ Edit Plan", callback_data="admin_edit_plan")
-    kb.button(text="🗑 Delete Plan", callback_data="admin_delete_plan")
-    kb.button(text="🔗 Set Channel ID", callback_data="admin_set_channel")
-    kb.button(text="👥 Set Group ID", callback_data="admin_set_group")
-    kb.button(text="⬅️ Back", callback_data="admin_back_categories")
-    kb.adjust(1)
-
     await c.message.edit_text(
         "⚙️ *Category Management*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=ADMIN_CATEGORY_KB
     )
 
 @dp.callback_query(F.data == "admin_add_plan")
@@ -645,44 +2948,36 @@ async def admin_add_plan_price(m: types.Message, state: FSMContext):
     data = await state.get_data()
     cat = data["admin_category"]
 
-    plan_id = f"p{int(asyncio.get_event_loop().time())}"
+    # the QR and reconciliation both need a real amount
+    if not parse_amount(m.text):
+        return await m.answer("❌ Price must contain an amount (example: 199 INR)")
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {
-            f"categories.{cat}.plans.{plan_id}": {
-                "label": data["plan_label"],
-                "days": data["plan_days"],
-                "price": m.text
-            }
-        }}
+    plan_id = new_plan_id()
+
+    plan = {
+        "label": data["plan_label"],
+        "days": data["plan_days"],
+        "price": m.text
+    }
+
+    await plans_col.insert_one(
+        {"_id": plan_id, "category": cat, **plan, "created_at": datetime.utcnow()}
     )
+    await touch_catalog()
 
     await state.clear()
     await m.answer("✅ Plan added successfully")
+    await render_plan_qr(m.chat.id, cat, plan_id, plan)
 
 @dp.callback_query(F.data == "admin_edit_plan")
 async def admin_edit_plan(c: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     cat = data["admin_category"]
 
-    settings = await get_settings()
-    plans = settings["categories"][cat].get("plans", {})
-
-    kb = InlineKeyboardBuilder()
-    for pid, plan in plans.items():
-        kb.button(
-            text=f"{plan['label']} – {plan['price']}",
-            callback_data=f"editplan_{pid}"
-        )
-
-    kb.button(text="⬅️ Back", callback_data="admin_cat_back")
-    kb.adjust(1)
-
     await c.message.edit_text(
         "✏️ *Select a plan to edit*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("admin_plans", cat, "edit")
     )
 
 @dp.callback_query(F.data.startswith("editplan_"))
@@ -717,24 +3012,34 @@ async def ask_new_value(c: types.CallbackQuery, state: FSMContext):
 async def save_edit_plan(m: types.Message, state: FSMContext):
     data = await state.get_data()
 
-    if "edit_plan_id" not in data or "edit_field" not in data:
-        return
+    # let later handlers (commands, admin states) see unrelated messages
+    if not data.get("edit_plan_id") or not data.get("edit_field"):
+        raise SkipHandler()
 
     cat = data["admin_category"]
     pid = data["edit_plan_id"]
     field = data["edit_field"]
 
-    settings = await get_settings()
-    plan = settings["categories"][cat]["plans"][pid]
+    category, plan = await asyncio.gather(get_category(cat), get_plan(cat, pid))
+    if not category or not plan:
+        await state.update_data(edit_plan_id=None, edit_field=None)
+        return await m.answer("❌ Plan not found")
+
+    if field == "price" and not parse_amount(m.text):
+        return await m.answer("❌ Price must contain an amount (example: 199 INR)")
+    if field == "days" and not m.text.isdigit():
+        return await m.answer("❌ Please enter number of days")
 
     old_value = plan[field]
     new_value = int(m.text) if field == "days" else m.text
 
     # Update DB
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{cat}.plans.{pid}.{field}": new_value}}
-    )
+    await plans_col.update_one({"_id": pid}, {"$set": {field: new_value}})
+    await touch_catalog()
+
+    # amount / note inside the QR depend on these
+    if field in ("label", "price"):
+        await render_plan_qr(m.chat.id, cat, pid, {**plan, field: new_value}, preview=False)
 
     # Clear only edit-related state
     await state.update_data(edit_plan_id=None, edit_field=None)
@@ -742,7 +3047,7 @@ async def save_edit_plan(m: types.Message, state: FSMContext):
     # ✅ Confirmation message
     await m.answer(
         "✅ <b>Plan Updated Successfully</b>\n\n"
-        f"📂 <b>Category:</b> {settings['categories'][cat]['name']}\n"
+        f"📂 <b>Category:</b> {category['name']}\n"
         f"📦 <b>Plan:</b> {plan['label']}\n"
         f"✏️ <b>Field:</b> {field}\n"
         f"🔁 <b>From:</b> {old_value}\n"
@@ -751,22 +3056,10 @@ async def save_edit_plan(m: types.Message, state: FSMContext):
     )
 
     # 🔙 Show Edit Plan list again (ONE STEP BACK UI)
-    plans = settings["categories"][cat].get("plans", {})
-    kb = InlineKeyboardBuilder()
-
-    for pid2, p in plans.items():
-        kb.button(
-            text=f"{p['label']} – {p['price']}",
-            callback_data=f"editplan_{pid2}"
-        )
-
-    kb.button(text="⬅️ Back", callback_data="admin_cat_back")
-    kb.adjust(1)
-
     await m.answer(
         "✏️ <b>Select another plan to edit</b>",
         parse_mode="HTML",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("admin_plans", cat, "edit")
     )
 
 #delete plan
@@ -776,23 +3069,10 @@ async def admin_delete_plan(c: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     cat = data["admin_category"]
 
-    settings = await get_settings()
-    plans = settings["categories"][cat].get("plans", {})
-
-    kb = InlineKeyboardBuilder()
-    for pid, plan in plans.items():
-        kb.button(
-            text=f"🗑 {plan['label']} – {plan['price']}",
-            callback_data=f"delplan_{pid}"
-        )
-
-    kb.button(text="⬅️ Back", callback_data="admin_cat_back")
-    kb.adjust(1)
-
     await c.message.edit_text(
         "🗑 *Select plan to delete*",
         parse_mode="Markdown",
-        reply_markup=kb.as_markup()
+        reply_markup=await cached_markup("admin_plans", cat, "delete")
     )
 
 @dp.callback_query(F.data.startswith("delplan_"))
@@ -816,10 +3096,8 @@ async def delete_plan_final(c: types.CallbackQuery, state: FSMContext):
     cat = data["admin_category"]
     pid = data["delete_plan_id"]
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$unset": {f"categories.{cat}.plans.{pid}": ""}}
-    )
+    await plans_col.delete_one({"_id": pid, "category": cat})
+    await touch_catalog()
 
     await c.answer("Deleted")
     await c.message.edit_text("🗑 Plan deleted successfully")
@@ -841,10 +3119,8 @@ async def admin_save_channel(m: types.Message, state: FSMContext):
     data = await state.get_data()
     cat = data["admin_category"]
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{cat}.channel_id": int(m.text)}}
-    )
+    await categories_col.update_one({"_id": cat}, {"$set": {"channel_id": int(m.text)}})
+    await touch_catalog()
 
     await state.clear()
     await m.answer("✅ Channel ID saved")
@@ -859,10 +3135,8 @@ async def admin_save_group(m: types.Message, state: FSMContext):
     data = await state.get_data()
     cat = data["admin_category"]
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{cat}.group_id": int(m.text)}}
-    )
+    await categories_col.update_one({"_id": cat}, {"$set": {"group_id": int(m.text)}})
+    await touch_catalog()
 
     await state.clear()
     await m.answer("✅ Group ID saved")
@@ -871,15 +3145,14 @@ async def admin_save_group(m: types.Message, state: FSMContext):
 #view category #
 @dp.message(F.text == "📋 View Categories")
 async def view_categories(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
 
-    s = await get_settings()
     text = "📋 *Categories*\n\n"
 
-    for k, v in s["categories"].items():
+    for v in await get_categories():
         text += (
-            f"🔑 `{k}`\n"
+            f"🔑 `{v['_id']}`\n"
             f"📛 {v['name']}\n"
             f"💰 {v['price']}\n"
             f"🔗 {v['link']}\n\n"
@@ -889,7 +3162,7 @@ async def view_categories(m: types.Message):
 
 @dp.message(F.text == "➕ Add Category")
 async def add_cat_start(m: types.Message, state: FSMContext):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
     await state.set_state(UserState.add_cat_key)
     await m.answer("Enter *category key* (example: movie)", parse_mode="Markdown")
@@ -917,22 +3190,21 @@ async def add_cat_link(m: types.Message, state: FSMContext):
     data = await state.get_data()
     await state.clear()
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {
-            f"categories.{data['key']}": {
-                "name": data["name"],
-                "price": data["price"],
-                "link": m.text
-            }
-        }}
+    await categories_col.update_one(
+        {"_id": data["key"]},
+        {
+            "$set": {"name": data["name"], "price": data["price"], "link": m.text},
+            "$setOnInsert": {"created_at": datetime.utcnow()}
+        },
+        upsert=True
     )
+    await touch_catalog()
 
     await m.answer("✅ Category added successfully")
 
 @dp.message(F.text == "✏️ Edit Category")
 async def edit_cat_start(m: types.Message, state: FSMContext):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
     await state.set_state(UserState.edit_cat_select)
     await m.answer("Enter *category key* to edit", parse_mode="Markdown")
@@ -954,17 +3226,15 @@ async def save_edit(m: types.Message, state: FSMContext):
     data = await state.get_data()
     await state.clear()
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{data['key']}.{data['field']}": m.text}}
-    )
+    await categories_col.update_one({"_id": data["key"]}, {"$set": {data["field"]: m.text}})
+    await touch_catalog()
 
     await m.answer("✅ Category updated")
 
 
 @dp.message(F.text == "🗑 Delete Category")
 async def delete_cat_start(m: types.Message, state: FSMContext):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
     await state.set_state(UserState.delete_cat)
     await m.answer("Enter *category key* to delete", parse_mode="Markdown")
@@ -973,17 +3243,17 @@ async def delete_cat_start(m: types.Message, state: FSMContext):
 async def delete_cat(m: types.Message, state: FSMContext):
     await state.clear()
 
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$unset": {f"categories.{m.text.lower()}": ""}}
-    )
+    key = m.text.lower()
+    await categories_col.delete_one({"_id": key})
+    await plans_col.delete_many({"category": key})
+    await touch_catalog()
 
     await m.answer("🗑 Category deleted")
 
 
 @dp.message(Command("msg"))
 async def admin_msg(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
 
     parts = m.text.split(maxsplit=2)
@@ -1004,102 +3274,867 @@ async def admin_msg(m: types.Message):
     await m.answer("✅ Message sent")
 
 
+# ================= BROADCAST =================
+# A broadcast is a document in broadcasts_col. Recipients are streamed in
+# user_id order and last_user_id is checkpointed after every batch, so a
+# broadcast whose worker died is picked up again (at most one batch resent)
+# by broadcast_supervisor once its lease, renewed by a heartbeat, runs out.
+# running broadcast tasks in this process by broadcast _id
+broadcast_tasks = {}
+
+def parse_broadcast_filter(token):
+    if token == "all":
+        return {"kind": "all"}
+    if token == "active":
+        return {"kind": "active"}
+    if token.startswith("cat:") and len(token) > 4:
+        return {"kind": "category", "category": token[4:]}
+    return None
+
+def broadcast_filter_label(f):
+    if f["kind"] == "category":
+        return f"active in {f['category']}"
+    return "all users" if f["kind"] == "all" else "active subscribers"
+
+def broadcast_subs_query(f):
+    q = {"status": "active"}
+    if f["kind"] == "category":
+        q["category"] = f["category"]
+    return q
+
+async def count_broadcast_recipients(f):
+    if f["kind"] == "all":
+        return await users_col.count_documents({"blocked": {"$ne": True}})
+
+    pipeline = [
+        {"$match": broadcast_subs_query(f)},
+        {"$group": {"_id": "$user_id"}},
+        {"$count": "n"}
+    ]
+    res = await subs_col.aggregate(pipeline).to_list(1)
+    return res[0]["n"] if res else 0
+
+async def broadcast_recipients(b):
+    f = b["filter"]
+    if f["kind"] == "all":
+        q = {"user_id": {"$gt": b["last_user_id"]}, "blocked": {"$ne": True}}
+        cursor = users_col.find(q, {"_id": 0, "user_id": 1})
+    else:
+        q = {**broadcast_subs_query(f), "user_id": {"$gt": b["last_user_id"]}}
+        cursor = subs_col.find(q, {"_id": 0, "user_id": 1})
+
+    async def without_blocked(batch):
+        if f["kind"] == "all":
+            return batch
+        blocked = set(await users_col.distinct(
+            "user_id", {"user_id": {"$in": batch}, "blocked": True}
+        ))
+        return [u for u in batch if u not in blocked]
+
+    batch, prev = [], None
+    async for doc in cursor.sort("user_id", 1).batch_size(BROADCAST_BATCH):
+        uid = doc["user_id"]
+        if uid == prev:  # several subscriptions, one message
+            continue
+        prev = uid
+        batch.append(uid)
+        if len(batch) >= BROADCAST_BATCH:
+            yield batch[-1], await without_blocked(batch)
+            batch = []
+
+    if batch:
+        yield batch[-1], await without_blocked(batch)
+
+async def deliver_broadcast(b, uid):
+    try:
+        if b.get("copy_from"):
+            await bot.copy_message(uid, b["copy_from"]["chat_id"], b["copy_from"]["message_id"])
+        else:
+            await bot.send_message(uid, b["text"])
+        return "sent"
+    except TelegramForbiddenError:
+        return "blocked"
+    except TelegramAPIError:
+        return "failed"
+
+def broadcast_stop_kb(b):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="⏹ Stop", callback_data=f"bc_stop_{b['_id']}")
+    ]])
+
+async def report_broadcast(b, rate, state="running"):
+    done = b["sent"] + b["failed"] + b["blocked"]
+    left = max(b["total"] - done, 0)
+    eta = f"{int(left / rate // 60)}m {int(left / rate % 60)}s" if rate and state == "running" else "-"
+
+    try:
+        await bot.edit_message_text(
+            f"📢 <b>Broadcast {state}</b>\n\n"
+            f"👥 Recipients: {b['total']} ({html.escape(broadcast_filter_label(b['filter']))})\n"
+            f"✅ Sent: {b['sent']}\n"
+            f"🚫 Blocked: {b['blocked']}\n"
+            f"❌ Failed: {b['failed']}\n"
+            f"⚡ Rate: {rate:.1f}/s\n"
+            f"⏳ ETA: {eta}",
+            chat_id=b["admin_chat"],
+            message_id=b["status_message_id"],
+            parse_mode="HTML",
+            reply_markup=broadcast_stop_kb(b) if state == "running" else None
+        )
+    except TelegramAPIError as e:
+        if "not modified" not in str(e):
+            logging.warning("Broadcast %s progress update failed: %s", b["_id"], e)
+
+async def broadcast_heartbeat(b):
+    # keep the lease while a slow batch is still being delivered
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE / 3)
+        try:
+            res = await broadcasts_col.update_one(
+                {"_id": b["_id"], "status": "running", "owner": b["owner"]},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=BROADCAST_LEASE)}}
+            )
+        except PyMongoError as e:
+            logging.warning("Broadcast %s heartbeat failed: %s", b["_id"], e)
+            continue
+        if res.matched_count == 0:
+            return
+
+async def run_broadcast(b):
+    heartbeat = asyncio.create_task(broadcast_heartbeat(b))
+    try:
+        await deliver_broadcast_batches(b)
+    finally:
+        heartbeat.cancel()
+
+async def deliver_broadcast_batches(b):
+    outbound_priority.set(BACKGROUND)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def deliver(uid):
+        async with sem:
+            return await deliver_broadcast(b, uid)
+
+    started = time.monotonic()
+    started_count = b["sent"] + b["failed"] + b["blocked"]
+    last_report = 0.0
+    rate = 0.0
+
+    async for last_uid, batch in broadcast_recipients(b):
+        results = await asyncio.gather(*(deliver(u) for u in batch))
+
+        blocked = [u for u, r in zip(batch, results) if r == "blocked"]
+        for u in blocked:
+            # so their next /start clears the flag again
+            verified_users.pop(u)
+        if blocked:
+            await users_col.update_many(
+                {"user_id": {"$in": blocked}},
+                {"$set": {"blocked": True}}
+            )
+
+        inc = {k: results.count(k) for k in ("sent", "failed", "blocked")}
+        now = datetime.utcnow()
+        res = await broadcasts_col.update_one(
+            {"_id": b["_id"], "status": "running", "owner": b["owner"]},
+            {
+                "$set": {
+                    "last_user_id": last_uid,
+                    "updated_at": now
+                },
+                "$inc": inc
+            }
+        )
+        for k, v in inc.items():
+            b[k] += v
+
+        elapsed = time.monotonic() - started
+        rate = (b["sent"] + b["failed"] + b["blocked"] - started_count) / elapsed if elapsed else 0.0
+
+        # stopped by an admin (or taken over by another worker)
+        if res.matched_count == 0:
+            return await report_broadcast(b, rate, "stopped")
+
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_EVERY:
+            last_report = time.monotonic()
+            await report_broadcast(b, rate)
+
+    await broadcasts_col.update_one(
+        {"_id": b["_id"], "status": "running", "owner": b["owner"]},
+        {"$set": {"status": "done", "finished_at": datetime.utcnow()}}
+    )
+    await report_broadcast(b, rate, "finished")
+
+def start_broadcast_task(b):
+    task = asyncio.create_task(run_broadcast(b))
+    broadcast_tasks[b["_id"]] = task
+    task.add_done_callback(lambda t: broadcast_tasks.pop(b["_id"], None))
+
+async def claim_broadcast(query):
+    # a token per claim, so a stale run on this same worker can't checkpoint
+    now = datetime.utcnow()
+    return await broadcasts_col.find_one_and_update(
+        query,
+        {"$set": {
+            "status": "running",
+            "owner": f"{WORKER_ID}:{secrets.token_hex(4)}",
+            "lease_until": now + timedelta(seconds=BROADCAST_LEASE)
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def broadcast_supervisor():
+    # resume broadcasts whose worker stopped checkpointing
+    while True:
+        try:
+            while True:
+                b = await claim_broadcast({
+                    "_id": {"$nin": list(broadcast_tasks)},
+                    "status": "running",
+                    "lease_until": {"$lt": datetime.utcnow()}
+                })
+                if not b:
+                    break
+                logging.info("Resuming broadcast %s after user %s", b["_id"], b["last_user_id"])
+                start_broadcast_task(b)
+        except PyMongoError as e:
+            logging.warning("Broadcast supervisor failed: %s", e)
+
+        await asyncio.sleep(BROADCAST_LEASE / 2)
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+
+    parts = m.text.split(maxsplit=1)
+    rest = parts[1] if len(parts) > 1 else ""
+
+    f = parse_broadcast_filter(rest.split(maxsplit=1)[0]) if rest else None
+    if f:
+        rest = rest.split(maxsplit=1)[1] if len(rest.split(maxsplit=1)) > 1 else ""
+    else:
+        f = {"kind": "all"}
+
+    b = {
+        "filter": f,
+        "status": "draft",
+        "admin_chat": m.chat.id,
+        "last_user_id": -1,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "created_at": datetime.utcnow()
+    }
+    if m.reply_to_message:
+        b["copy_from"] = {"chat_id": m.chat.id, "message_id": m.reply_to_message.message_id}
+    elif rest:
+        b["text"] = rest
+    else:
+        return await m.answer(
+            "Usage:\n"
+            "/broadcast [all|active|cat:key] message\n"
+            "or reply to a message with /broadcast [all|active|cat:key]"
+        )
+
+    if f["kind"] == "category" and not await get_category(f["category"]):
+        return await m.answer("❌ Category not found")
+
+    b["total"] = await count_broadcast_recipients(f)
+    await broadcasts_col.insert_one(b)
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Start", callback_data=f"bc_start_{b['_id']}"),
+        InlineKeyboardButton(text="❌ Cancel", callback_data=f"bc_stop_{b['_id']}")
+    ]])
+    await m.answer(
+        f"📢 <b>Broadcast to {b['total']} users</b> ({html.escape(broadcast_filter_label(f))})\n\nStart now?",
+        parse_mode="HTML",
+        reply_markup=kb
+    )
+
+@dp.callback_query(F.data.startswith("bc_start_"))
+async def broadcast_start(c: types.CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return
+
+    b = await claim_broadcast({"_id": ObjectId(c.data.split("_", 2)[2]), "status": "draft"})
+    if not b:
+        return await c.answer("Already started or cancelled", show_alert=True)
+
+    await broadcasts_col.update_one(
+        {"_id": b["_id"]},
+        {"$set": {"status_message_id": c.message.message_id, "started_at": datetime.utcnow()}}
+    )
+    b["status_message_id"] = c.message.message_id
+
+    await c.answer("Broadcast started")
+    await report_broadcast(b, 0.0)
+    start_broadcast_task(b)
+
+@dp.callback_query(F.data.startswith("bc_stop_"))
+async def broadcast_stop(c: types.CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return
+
+    await broadcasts_col.update_one(
+        {"_id": ObjectId(c.data.split("_", 2)[2]), "status": {"$in": ["draft", "running"]}},
+        {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}}
+    )
+    await c.answer("Broadcast stopped")
+    # a draft has no runner that would update the message
+    await c.message.edit_reply_markup(reply_markup=None)
+
 # ================= ADMIN COMMANDS =================
 @dp.message(Command("setprice"))
 async def set_price(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
     _, cat, price = m.text.split(maxsplit=2)
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{cat}.price": price}}
-    )
+    await categories_col.update_one({"_id": cat}, {"$set": {"price": price}})
+    await touch_catalog()
     await m.answer("✅ Price updated")
 
 @dp.message(Command("setlink"))
 async def set_link(m: types.Message):
-    if m.from_user.id != ADMIN_ID:
+    if not is_admin(m.from_user.id):
         return
     _, cat, link = m.text.split(maxsplit=2)
-    await settings_col.update_one(
-        {"_id": "main"},
-        {"$set": {f"categories.{cat}.link": link}}
-    )
+    await categories_col.update_one({"_id": cat}, {"$set": {"link": link}})
+    await touch_catalog()
     await m.answer("✅ Link updated")
+
+@dp.message(Command("setupi"))
+async def set_upi(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    parts = m.text.split(maxsplit=1)
+    if len(parts) < 2:
+        return await m.answer("Usage:\n/setupi name@bank")
+    await update_settings(
+        {"$set": {"upi_id": parts[1].strip()}}
+    )
+
+    # every plan QR encodes the UPI id, re-render them now rather than on payment
+    count = 0
+    async for plan in plans_col.find({}, {"qr": 0}):
+        await render_plan_qr(m.chat.id, plan["category"], plan["_id"], plan, preview=False)
+        count += 1
+
+    await m.answer(f"✅ UPI ID updated\n🔳 {count} plan QR codes refreshed")
+
+@dp.message(Command("stats"))
+async def runtime_stats(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+
+    out = outbound.stats
+    avg = out["latency_total"] / out["sent"] if out["sent"] else 0.0
+    sch = scheduler_stats
+    upd = update_ordering.stats
+    await m.answer(
+        "📊 *Runtime Stats*\n\n"
+        f"📤 Outbound queue: {out['queued']}\n"
+        f"✅ Sent: {out['sent']} (avg {avg * 1000:.0f} ms, max {out['latency_max'] * 1000:.0f} ms)\n"
+        f"🔁 Flood retries: {out['retries']}\n"
+        f"❌ Errors: {out['errors']}\n\n"
+        f"⏰ Scheduler: {sch['jobs']} jobs in {sch['passes']} passes, {sch['failed']} failed\n"
+        f"⏱ Last pass: {sch['last_pass_jobs']} jobs in {sch['last_pass_seconds']:.1f}s\n\n"
+        f"📥 Updates: {upd['active']} running, {upd['waiting']} waiting, "
+        f"{len(update_ordering.keys)} users busy (max queue {upd['max_depth']})"
+        + "".join(f"\n   • {kind} {kid}: {depth} queued" for (kind, kid), depth in update_ordering.top_keys()),
+        parse_mode="Markdown"
+    )
+
+@dp.message(Command("reconcile"))
+async def reconcile_start(m: types.Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.set_state(UserState.waiting_for_statement)
+    await m.answer("🏦 Send the bank / UPI statement as a *CSV file*", parse_mode="Markdown")
+
+@dp.message(UserState.waiting_for_statement)
+async def reconcile_statement(m: types.Message, state: FSMContext):
+    if not m.document:
+        return await m.answer("❌ Please send the statement as a CSV document")
+    await state.clear()
+
+    await m.answer("⏳ Reconciling…")
+    # spooled to disk, the whole statement is never held in memory
+    with tempfile.TemporaryFile() as f:
+        await bot.download(m.document, destination=f)
+        f.seek(0)
+        report = await reconcile_file(f, m.from_user.id)
+
+    await m.answer(
+        format_reconcile_report(report),
+        parse_mode="Markdown",
+        reply_markup=reconcile_suggestions_kb(report)
+    )
+
+@dp.message(Command("reviewers"))
+async def reviewers_cmd(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+
+    lines = [f"👮 <b>Reviewers</b> ({ASSIGN_STRATEGY}, last {REVIEWER_STATS_DAYS}d)\n"]
+    for r, st in (await reviewer_stats()).items():
+        lines.append(
+            f"• <code>{r}</code>{'' if r in REVIEWER_IDS else ' (inactive)'} – "
+            f"📥 {st['backlog']} open · ✅ {st['approved']} approved · "
+            f"⏱ median {format_duration(st['median_seconds'])}"
+        )
+    await m.answer("\n".join(lines), parse_mode="HTML")
+
+@dp.message(Command("slow"))
+async def slow_cmd(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+    if PROFILE_SLOW_MS <= 0:
+        return await m.answer("Profiling is off (set PROFILE_SLOW_MS)")
+
+    records = list(slow_updates)
+    parts = m.text.split()
+
+    # /slow <n> → cProfile output of record n as a file
+    if len(parts) > 1 and parts[1].isdigit():
+        n = int(parts[1])
+        if not 1 <= n <= len(records) or not records[-n]["profile"]:
+            return await m.answer("❌ No profile for that record")
+        r = records[-n]
+        return await m.answer_document(
+            types.BufferedInputFile(r["profile"].encode(), f"profile_{r['handler']}.txt"),
+            caption=f"{r['handler']} – {r['total_ms']} ms"
+        )
+
+    if not records:
+        return await m.answer(f"✅ No updates slower than {PROFILE_SLOW_MS} ms")
+
+    lines = [f"🐢 Slow updates (> {PROFILE_SLOW_MS} ms), newest first\n"]
+    for n, r in enumerate(reversed(records[-15:]), 1):
+        lines.append(
+            f"{n}. {r['handler']} – {r['total_ms']} ms "
+            f"(mongo {r['mongo_ms']}, tg {r['telegram_ms']}, wait {r['queue_ms']}, "
+            f"other {r['other_ms']}){' 📄' if r['profile'] else ''}"
+        )
+    lines.append("\n/slow n → profile of record n")
+    await m.answer("\n".join(lines))
+
+@dp.message(Command("cachestats"))
+async def cache_stats(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return
+
+    st = settings_cache_stats()
+    qr = qr_cache.stats()
+    vu = verified_users.stats()
+    cc = catalog_cache.stats()
+    await m.answer(
+        "📊 *Cache Stats*\n\n"
+        f"⚙️ Settings v{st['version']}\n"
+        f"✅ Hits: {st['hits']}\n"
+        f"❌ Misses: {st['misses']}\n"
+        f"🔄 Reloads: {st['reloads']}\n"
+        f"📈 Hit rate: {st['hit_rate']:.1%}\n\n"
+        f"🔳 QR codes: {qr['size']}/{QR_CACHE_SIZE} "
+        f"(hit rate {qr['hit_rate']:.1%})\n"
+        f"👤 Verified users: {vu['size']}/{VERIFIED_CACHE_SIZE} "
+        f"(hit rate {vu['hit_rate']:.1%})\n"
+        f"📂 Catalog: {cc['size']}/{CATALOG_CACHE_SIZE} "
+        f"(hit rate {cc['hit_rate']:.1%})",
+        parse_mode="Markdown"
+    )
 # ===== background subscription===========
 
 from datetime import datetime, timedelta
 
-async def subscription_watcher():
+# Reminders and expiries are persistent jobs in jobs_col (one per kind per
+# subscription, _id "<kind>:<sub_id>"). Each process keeps the next
+# JOB_HEAP_SIZE pending jobs in a heap, sleeps until the first one is due and
+# claims it atomically, so several bot processes never run the same job.
+
+# reminder goes out while 1-2 full days are left
+REMINDER_FROM = timedelta(days=1)
+REMINDER_UNTIL = timedelta(days=3)
+
+job_heap = []
+scheduler_wakeup = asyncio.Event()
+scheduler_stats = {"passes": 0, "jobs": 0, "failed": 0, "last_pass_jobs": 0, "last_pass_seconds": 0.0}
+
+# status updates from job handlers, written with bulk_write once per pass
+subs_writes = BulkWriter(subs_col)
+jobs_writes = BulkWriter(jobs_col)
+
+async def schedule_subscription_jobs(sub, reset=True):
+    now = datetime.utcnow()
+    jobs = [("expiry", sub["expires_at"])]
+    if sub["expires_at"] - now >= REMINDER_FROM:
+        jobs.append(("reminder", max(now, sub["expires_at"] - REMINDER_UNTIL)))
+
+    for kind, run_at in jobs:
+        job = {
+            "kind": kind,
+            "sub_id": sub["_id"],
+            "user_id": sub["user_id"],
+            "category": sub["category"],
+            "run_at": run_at,
+            "status": "pending",
+            "attempts": 0,
+            "locked_by": None,
+            "locked_until": None
+        }
+        await jobs_col.update_one(
+            {"_id": f"{kind}:{sub['_id']}"},
+            {"$set" if reset else "$setOnInsert": job},
+            upsert=True
+        )
+
+    scheduler_wakeup.set()
+
+async def backfill_subscription_jobs():
+    # subscriptions created before the scheduler existed
+    if not await run_once("subscription_jobs_v1"):
+        return
+
+    count = 0
+    async for sub in subs_col.find({"status": "active"}):
+        await schedule_subscription_jobs(sub, reset=False)
+        count += 1
+    await migration_done("subscription_jobs_v1")
+    logging.info("Scheduler: backfilled jobs for %s subscriptions", count)
+
+async def subs_unique_index():
+    # renewals rely on this index to never create a second row
+    info = await subs_col.index_information()
+    return any(
+        list(ix["key"]) == [("user_id", 1), ("category", 1)] and ix.get("unique")
+        for ix in info.values()
+    )
+
+async def merge_duplicate_subscriptions():
+    # before renewals stacked, every approval inserted its own row. Keep the
+    # one expiring last per (user_id, category), fold the rest into history.
+    # Reruns on every boot until the unique index exists.
+    if await subs_unique_index():
+        return
+
+    pipeline = [
+        {"$sort": {"expires_at": 1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "category": "$category"},
+            "subs": {"$push": "$$ROOT"},
+            "n": {"$sum": 1}
+        }},
+        {"$match": {"n": {"$gt": 1}}}
+    ]
+    merged = 0
+    async for group in subs_col.aggregate(pipeline, allowDiskUse=True):
+        *older, keep = group["subs"]
+        history = [
+            {
+                "plan_id": s.get("plan_id"),
+                "approved_at": s.get("approved_at"),
+                "expires_at": s.get("expires_at"),
+                "approval_key": s.get("approval_key")
+            }
+            for s in older
+        ][-SUB_HISTORY_SIZE:]
+        old_ids = [s["_id"] for s in older]
+
+        await subs_col.update_one(
+            {"_id": keep["_id"]},
+            {"$push": {"history": {"$each": history, "$slice": -SUB_HISTORY_SIZE}}}
+        )
+        await subs_col.delete_many({"_id": {"$in": old_ids}})
+        await jobs_col.delete_many(
+            {"_id": {"$in": [f"{kind}:{i}" for i in old_ids for kind in JOB_HANDLERS]}}
+        )
+        if keep["status"] == "active":
+            await schedule_subscription_jobs(keep, reset=False)
+        merged += len(old_ids)
+
+    # the old non-unique (user_id, category) index has the same name
+    try:
+        await subs_col.drop_index("user_id_1_category_1")
+    except OperationFailure:
+        pass
+    logging.info("Merged %s duplicate subscriptions", merged)
+
+async def ensure_subs_unique():
+    if await subs_unique_index():
+        return
+    # an older replica inserted duplicates after the merge; merge again and
+    # refuse to start if the index still cannot be built
+    await merge_duplicate_subscriptions()
+    try:
+        await subs_col.create_index([("user_id", 1), ("category", 1)], unique=True)
+    except OperationFailure as e:
+        raise RuntimeError(f"unique (user_id, category) index on subscriptions is missing: {e}")
+
+async def refill_job_heap(now):
+    # jobs whose worker died mid-run become claimable again
+    await jobs_col.update_many(
+        {"status": "running", "locked_until": {"$lt": now}},
+        {"$set": {"status": "pending", "locked_by": None, "locked_until": None}}
+    )
+
+    job_heap.clear()
+    cursor = jobs_col.find({"status": "pending"}, {"run_at": 1})
+    async for job in cursor.sort("run_at", 1).limit(JOB_HEAP_SIZE):
+        heapq.heappush(job_heap, (job["run_at"], job["_id"]))
+
+async def claim_jobs(job_ids, now):
+    # one conditional update for the whole batch; the claim token tells us
+    # which of them this pass actually got
+    claim = f"{WORKER_ID}:{secrets.token_hex(4)}"
+    await jobs_col.update_many(
+        {"_id": {"$in": job_ids}, "status": "pending", "run_at": {"$lte": now}},
+        {
+            "$set": {
+                "status": "running",
+                "locked_by": claim,
+                "locked_until": now + timedelta(seconds=JOB_LEASE)
+            },
+            "$inc": {"attempts": 1}
+        }
+    )
+    return await jobs_col.find({"locked_by": claim}).to_list(None)
+
+async def run_reminder_job(job, sub):
+    now = datetime.utcnow()
+    if not sub or sub["status"] != "active" or sub.get("reminder_sent") or sub["expires_at"] <= now:
+        return
+
+    remaining = max((sub["expires_at"] - now).days, 1)
+    try:
+        await bot.send_message(
+            sub["user_id"],
+            f"⏰ *VIP Expiry Reminder*\n\n"
+            f"Your VIP will expire in *{remaining} day(s)*.\n"
+            f"Renew to continue access 🔄",
+            parse_mode="Markdown"
+        )
+    except TelegramForbiddenError:
+        # blocked the bot, retrying will not help
+        logging.info("Reminder to %s skipped: bot blocked", sub["user_id"])
+
+    # a renewal in the meantime moved expires_at and reset reminder_sent
+    await subs_writes.add(UpdateOne(
+        {"_id": sub["_id"], "expires_at": sub["expires_at"]},
+        {"$set": {"reminder_sent": True}}
+    ))
+
+async def expire_due_subscriptions(jobs, now):
+    # one conditional update flips every due subscription of the batch; a
+    # renewal that landed since keeps its row active. expired_by is the
+    # pass's job claim token, so only this pass kicks the users it expired.
+    expiries = [j for j in jobs if j["kind"] == "expiry"]
+    if not expiries:
+        return
+    await subs_col.update_many(
+        {
+            "_id": {"$in": [j["sub_id"] for j in expiries]},
+            "status": "active",
+            "expires_at": {"$lte": now}
+        },
+        {"$set": {"status": "expired", "expired_at": now, "expired_by": expiries[0]["locked_by"]}}
+    )
+
+async def run_expiry_job(job, sub):
+    if not sub:
+        return
+
+    # `sub` was read back after expire_due_subscriptions()
+    if sub["status"] == "active":
+        # extended since the job was scheduled
+        return sub["expires_at"]
+    if sub.get("expired_by") != job["locked_by"]:
+        # an earlier attempt expired it but the kick failed → kick again
+        if not (sub["status"] == "expired" and job["attempts"] > 1 and sub["expires_at"] <= datetime.utcnow()):
+            return
+
+    # the pass can run for a while behind the rate limiter; a renewal since
+    # expire_due_subscriptions() reactivated the row and unset expired_by
+    still_expired = await subs_col.count_documents(
+        {"_id": sub["_id"], "status": "expired", "expired_by": sub.get("expired_by")}, limit=1
+    )
+    if not still_expired:
+        return
+
+    uid = sub["user_id"]
+    cat = await get_category(sub["category"]) or {}
+
+    # Remove from channel / group
+    for chat_id in (cat.get("channel_id"), cat.get("group_id")):
+        if chat_id:
+            await bot.ban_chat_member(chat_id, uid)
+            await bot.unban_chat_member(chat_id, uid)
+
+    try:
+        await bot.send_message(
+            uid,
+            "❌ *Your VIP has expired*\n\n"
+            "You have been removed from the VIP access.\n"
+            "Renew anytime to regain access 💎",
+            parse_mode="Markdown"
+        )
+    except TelegramAPIError as e:
+        logging.info("Expiry notice to %s failed: %s", uid, e)
+
+JOB_HANDLERS = {
+    "reminder": run_reminder_job,
+    "expiry": run_expiry_job
+}
+
+async def run_job(job, sub):
+    update = {"locked_by": None, "locked_until": None}
+    ok = True
+    try:
+        # a handler may return a new run_at to push the job back
+        run_at = await JOB_HANDLERS[job["kind"]](job, sub)
+        if run_at:
+            update.update(status="pending", run_at=run_at, attempts=0)
+        else:
+            update.update(status="done", finished_at=datetime.utcnow())
+    except Exception as e:
+        ok = False
+        logging.warning("Job %s failed (attempt %s): %s", job["_id"], job["attempts"], e)
+        update["last_error"] = str(e)
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            update["status"] = "failed"
+        else:
+            delay = JOB_RETRY_BASE * 2 ** (job["attempts"] - 1)
+            update.update(status="pending", run_at=datetime.utcnow() + timedelta(seconds=delay))
+
+    # a renewal may have rescheduled the job meanwhile (locked_by reset);
+    # don't overwrite that with our result
+    await jobs_writes.add(UpdateOne(
+        {"_id": job["_id"], "locked_by": job["locked_by"]},
+        {"$set": update}
+    ))
+    return ok
+
+async def run_job_batch(jobs):
+    await expire_due_subscriptions(jobs, datetime.utcnow())
+    subs = {}
+    async for sub in subs_col.find({"_id": {"$in": [j["sub_id"] for j in jobs]}}):
+        subs[sub["_id"]] = sub
+
+    sem = asyncio.Semaphore(JOB_CONCURRENCY)
+
+    async def worker(job):
+        async with sem:
+            return await run_job(job, subs.get(job["sub_id"]))
+
+    results = await asyncio.gather(*(worker(j) for j in jobs))
+    return results.count(False)
+
+async def run_scheduler_pass():
+    now = datetime.utcnow()
+    await refill_job_heap(now)
+
+    due = []
+    while job_heap and job_heap[0][0] <= now:
+        due.append(heapq.heappop(job_heap)[1])
+    if not due:
+        return 0
+
+    started = time.monotonic()
+    jobs = await claim_jobs(due, now)  # the rest went to another process
+    failed = 0
+    try:
+        if jobs:
+            failed = await run_job_batch(jobs)
+    finally:
+        await subs_writes.flush()
+        await jobs_writes.flush()
+
+    took = time.monotonic() - started
+    scheduler_pass_seconds.observe(took)
+    scheduler_stats.update(
+        passes=scheduler_stats["passes"] + 1,
+        jobs=scheduler_stats["jobs"] + len(jobs),
+        failed=scheduler_stats["failed"] + failed,
+        last_pass_jobs=len(jobs),
+        last_pass_seconds=took
+    )
+    if jobs:
+        logging.info(
+            "Scheduler pass: %s jobs in %.1fs (%.1f/s), %s failed",
+            len(jobs), took, len(jobs) / took if took else 0, failed
+        )
+    return len(due)
+
+async def job_scheduler():
+    # reminders / kicks yield to interactive replies in the outbound queue
+    outbound_priority.set(BACKGROUND)
+
+    try:
+        await backfill_subscription_jobs()
+    except PyMongoError as e:
+        logging.warning("Scheduler backfill failed: %s", e)
+
     while True:
-        now = datetime.utcnow()
+        scheduler_wakeup.clear()
+        processed = 0
 
-        async for sub in subs_col.find({"status": "active"}):
-            uid = sub["user_id"]
-            expires_at = sub["expires_at"]
-            remaining = (expires_at - now).days
+        try:
+            processed = await run_scheduler_pass()
+        except PyMongoError as e:
+            logging.warning("Scheduler pass failed: %s", e)
 
-            settings = await get_settings()
-            cat = settings["categories"].get(sub["category"])
+        # more may be due beyond the heap window
+        if processed:
+            continue
 
-            # 🔔 REMINDER (2 or 1 days before)
-            if remaining in (1, 2) and not sub.get("reminder_sent"):
-                try:
-                    await bot.send_message(
-                        uid,
-                        f"⏰ *VIP Expiry Reminder*\n\n"
-                        f"Your VIP will expire in *{remaining} day(s)*.\n"
-                        f"Renew to continue access 🔄",
-                        parse_mode="Markdown"
-                    )
-                    await subs_col.update_one(
-                        {"_id": sub["_id"]},
-                        {"$set": {"reminder_sent": True}}
-                    )
-                except:
-                    pass
-
-            # ❌ EXPIRED
-            if remaining < 0:
-                try:
-                    # Remove from channel
-                    if cat.get("channel_id"):
-                        await bot.ban_chat_member(cat["channel_id"], uid)
-                        await bot.unban_chat_member(cat["channel_id"], uid)
-
-                    # Remove from group
-                    if cat.get("group_id"):
-                        await bot.ban_chat_member(cat["group_id"], uid)
-                        await bot.unban_chat_member(cat["group_id"], uid)
-
-                    await bot.send_message(
-                        uid,
-                        "❌ *Your VIP has expired*\n\n"
-                        "You have been removed from the VIP access.\n"
-                        "Renew anytime to regain access 💎",
-                        parse_mode="Markdown"
-                    )
-                except:
-                    pass
-
-                await subs_col.update_one(
-                    {"_id": sub["_id"]},
-                    {"$set": {"status": "expired"}}
-                )
+        # ⏳ Sleep until the next job is due
+        delay = JOB_MAX_SLEEP
+        if job_heap:
+            delay = (job_heap[0][0] - datetime.utcnow()).total_seconds()
+            delay = min(max(delay, 0.5), JOB_MAX_SLEEP)
 
-        # ⏳ Check every 10 minutes
-        await asyncio.sleep(600)
+        try:
+            await asyncio.wait_for(scheduler_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
 
 # ================= MAIN =================
 async def main():
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL")
+
+    await migrate_catalog()
+    # must run before the unique (user_id, category) index is built
+    await merge_duplicate_subscriptions()
+    await ensure_indexes()
+    await ensure_subs_unique()
+    if QUERY_AUDIT:
+        await audit_queries()
+    asyncio.create_task(loop_lag_monitor())
     await start_web()
-    await bot.delete_webhook(drop_pending_updates=True)
 
-    # 🔥 START AUTO EXPIRY TASK
-    asyncio.create_task(subscription_watcher())
+    # 🔄 KEEP SETTINGS CACHE IN SYNC WITH OTHER PROCESSES
+    asyncio.create_task(settings_sync())
+
+    # 🔥 START REMINDER / EXPIRY SCHEDULER
+    asyncio.create_task(job_scheduler())
+
+    # 📢 RESUME INTERRUPTED BROADCASTS
+    asyncio.create_task(broadcast_supervisor())
+
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logging.info("Webhook mode on %s", WEBHOOK_PATH)
+        # updates arrive through the web app from now on
+        await asyncio.Event().wait()
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot, handle_as_tasks=True)
 
-    await dp.start_polling(bot)
-    
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorCollection  # noqa: E402
+
+
+class FakeBot:
+    """Records Bot API calls instead of sending them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+        return call
+
+    def called(self, method):
+        return [c for c in self.calls if c[0] == method]
+
+
+def bulk_as_updates(writer):
+    async def flush():
+        ops, writer.ops = writer.ops, []
+        for op in ops:
+            await writer.col.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+    return flush
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Points every bot collection at a fresh in-memory database."""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient()["test"]
+    for name, value in list(vars(bot).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            monkeypatch.setattr(bot, name, database[value.name])
+    for writer in (bot.subs_writes, bot.jobs_writes):
+        monkeypatch.setattr(writer, "col", database[writer.col.name])
+        monkeypatch.setattr(writer, "ops", [])
+        # mongomock's bulk_write lags behind pymongo, apply the ops one by one
+        monkeypatch.setattr(writer, "flush", bulk_as_updates(writer))
+
+    # settings are served from the cache, no settings document needed
+    monkeypatch.setitem(bot.settings_cache, "doc", {"_id": "main", "upi_id": "name@bank", "version": 0})
+    monkeypatch.setitem(bot.settings_cache, "version", 0)
+    bot.catalog_cache.clear()
+    return database
+
+
+@pytest.fixture
+def fake_bot(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(bot, "bot", fake)
+    return fake
@@ -0,0 +1,135 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from pymongo.errors import AutoReconnect
+
+import bot
+
+KEY = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+
+class CountingCollection:
+    """Wraps a collection, counts writes and can fail the next ones."""
+
+    def __init__(self, col):
+        self.col = col
+        self.writes = 0
+        self.fail = 0
+
+    async def update_one(self, *args, **kwargs):
+        self.writes += 1
+        if self.fail:
+            self.fail -= 1
+            raise AutoReconnect("primary stepped down")
+        return await self.col.update_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.col, name)
+
+
+@pytest.fixture
+def fsm(db):
+    return CountingCollection(db["fsm"])
+
+
+def in_update(coro_fn):
+    # what FSMFlushMiddleware does around a handler
+    async def run(storage):
+        keys = set()
+        token = bot.fsm_keys.set(keys)
+        try:
+            await coro_fn(storage)
+        finally:
+            bot.fsm_keys.reset(token)
+        for k in keys:
+            await storage.flush(k)
+    return run
+
+
+def test_data_and_state_in_one_update_cost_one_write(fsm):
+    storage = bot.MongoStorage(fsm)
+
+    async def handler(storage):
+        await storage.set_data(KEY, {"category": "movie"})
+        await storage.set_state(KEY, bot.UserState.waiting_for_proof)
+
+    async def scenario():
+        await in_update(handler)(storage)
+        return await fsm.find_one({})
+
+    doc = asyncio.run(scenario())
+    assert fsm.writes == 1
+    assert doc["state"] == bot.UserState.waiting_for_proof.state
+    assert doc["data"] == {"category": "movie"}
+
+
+def test_clear_deletes_the_document(fsm):
+    storage = bot.MongoStorage(fsm)
+
+    async def clear(storage):
+        # FSMContext.clear()
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+
+    async def scenario():
+        await storage.set_data(KEY, {"plan_id": "p1"})
+        await storage.set_state(KEY, bot.UserState.waiting_for_proof)
+        await in_update(clear)(storage)
+        return await fsm.count_documents({})
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_failed_write_stays_pending_and_is_read_back(fsm):
+    storage = bot.MongoStorage(fsm)
+
+    async def scenario():
+        fsm.fail = 1
+        with pytest.raises(AutoReconnect):
+            await storage.set_state(KEY, bot.UserState.waiting_for_help)
+        state = await storage.get_state(KEY)
+        # a newer value queued meanwhile wins over the failed one
+        storage.pending[storage.key_builder.build(KEY)]["state"] = "UserState:waiting_for_proof"
+        await storage.flush(storage.key_builder.build(KEY))
+        return state, await fsm.find_one({})
+
+    state, doc = asyncio.run(scenario())
+    assert state == bot.UserState.waiting_for_help.state
+    assert doc["state"] == "UserState:waiting_for_proof"
+
+
+def test_flush_middleware_tells_the_user_when_saving_fails(fsm, fake_bot):
+    storage = bot.MongoStorage(fsm)
+    middleware = bot.FSMFlushMiddleware(storage)
+
+    async def handler(event, data):
+        await storage.set_state(KEY, bot.UserState.waiting_for_proof)
+
+    async def scenario():
+        fsm.fail = middleware.attempts
+        with pytest.raises(AutoReconnect):
+            await middleware(handler, None, {"event_chat": SimpleNamespace(id=5)})
+
+    asyncio.run(scenario())
+    assert fsm.writes == middleware.attempts
+    assert [c[1][0] for c in fake_bot.called("send_message")] == [5]
+    assert storage.pending  # kept for the next flush
+
+
+def test_flush_middleware_retries_a_transient_failure(fsm, fake_bot):
+    storage = bot.MongoStorage(fsm)
+    middleware = bot.FSMFlushMiddleware(storage)
+
+    async def handler(event, data):
+        await storage.set_state(KEY, bot.UserState.waiting_for_proof)
+
+    async def scenario():
+        fsm.fail = 1
+        await middleware(handler, None, {"event_chat": SimpleNamespace(id=5)})
+        return await fsm.find_one({})
+
+    doc = asyncio.run(scenario())
+    assert doc["state"] == bot.UserState.waiting_for_proof.state
+    assert fake_bot.called("send_message") == []
@@ -0,0 +1,113 @@
+import random
+from urllib.parse import parse_qs, urlsplit
+
+import bot
+
+
+def upi_params(uri):
+    return {k: v[0] for k, v in parse_qs(urlsplit(uri).query).items()}
+
+
+def test_parse_amount_plain():
+    assert bot.parse_amount("199 INR") == "199.00"
+    assert bot.parse_amount("₹99.5") == "99.50"
+
+
+def test_parse_amount_thousands_separator():
+    assert bot.parse_amount("1,299 INR") == "1299.00"
+    assert bot.parse_amount("₹1,999/-") == "1999.00"
+    assert bot.parse_amount("₹ 1,29,999.50") == "129999.50"
+
+
+def test_parse_amount_without_amount():
+    assert bot.parse_amount("free") is None
+    assert bot.parse_amount("") is None
+    assert bot.parse_amount("0 INR") is None
+
+
+def test_upi_uri_amount():
+    params = upi_params(bot.upi_uri("name@bank", "1299.00", "VIP adult 1M", "adultp1"))
+    assert params["pa"] == "name@bank"
+    assert params["am"] == "1299.00"
+    assert params["cu"] == "INR"
+    assert params["tn"] == "VIP adult 1M"
+    assert params["tr"] == "adultp1"
+
+
+def test_upi_uri_without_amount():
+    params = upi_params(bot.upi_uri("name@bank"))
+    assert "am" not in params
+    assert "pn" not in params
+
+
+def test_plan_upi_uri_uses_full_price():
+    plan = {"label": "1 Year", "price": "₹1,299/-"}
+    params = upi_params(bot.plan_upi_uri("name@bank", "adult", "p1", plan))
+    assert params["am"] == "1299.00"
+
+
+def test_plan_upi_uri_unparseable_price_skips_amount():
+    plan = {"label": "Trial", "price": "ask admin"}
+    assert "am" not in upi_params(bot.plan_upi_uri("name@bank", "adult", "p1", plan))
+
+
+def test_tagged_amount_adds_paise():
+    assert bot.tagged_amount("199.00", 37) == "199.37"
+    assert bot.tagged_amount("99.50", 99) == "100.49"
+
+
+def band_bits(bands):
+    # undo hash_bands: strip the band index and concatenate the bits back
+    value, start = 0, 0
+    for i, band in enumerate(bands):
+        assert band >> 32 == i
+        width = (bot.PROOF_HASH_BITS - start) // (bot.PROOF_HASH_BANDS - i)
+        value |= (band & ((1 << width) - 1)) << start
+        start += width
+    assert start == bot.PROOF_HASH_BITS
+    return value
+
+
+def test_hash_bands_cover_every_bit():
+    value = random.Random(1).getrandbits(bot.PROOF_HASH_BITS)
+    bands = bot.hash_bands(value)
+    assert len(bands) == bot.PROOF_HASH_BANDS
+    assert band_bits(bands) == value
+
+
+def test_hash_bands_find_close_hashes():
+    rng = random.Random(2)
+    for _ in range(200):
+        value = rng.getrandbits(bot.PROOF_HASH_BITS)
+        flipped = value
+        for bit in rng.sample(range(bot.PROOF_HASH_BITS), bot.PROOF_HASH_BANDS - 1):
+            flipped ^= 1 << bit
+        assert set(bot.hash_bands(value)) & set(bot.hash_bands(flipped))
+
+
+def test_hash_bands_equal_bits_in_other_band_differ():
+    assert not set(bot.hash_bands(0)) & set(bot.hash_bands((1 << bot.PROOF_HASH_BITS) - 1))
+    assert len(set(bot.hash_bands(0))) == bot.PROOF_HASH_BANDS
+
+
+def test_users_search_query_id_prefix():
+    query = bot.users_search_query("12")
+    ranges = [r["user_id"] for r in query["$or"]]
+    assert ranges[0] == {"$gte": 12, "$lt": 13}
+    assert ranges[1] == {"$gte": 120, "$lt": 130}
+    assert len(ranges) == bot.USER_ID_DIGITS - 1
+
+
+def test_users_search_query_longest_id():
+    longest = int("1" * bot.USER_ID_DIGITS)
+    query = bot.users_search_query(str(longest))
+    assert query == {"$or": [{"user_id": {"$gte": longest, "$lt": longest + 1}}]}
+
+
+def test_users_search_query_too_long():
+    assert bot.users_search_query("1" * (bot.USER_ID_DIGITS + 1)) is None
+
+
+def test_users_search_query_username():
+    assert bot.users_search_query("@Bob.x") == {"username": {"$regex": "^Bob\\.x"}}
+    assert bot.users_search_query("007") == {"username": {"$regex": "^007"}}
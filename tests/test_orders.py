@@ -0,0 +1,131 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+import bot
+
+
+async def seed_order(db, **extra):
+    await db["categories"].insert_one({"_id": "movie", "name": "Movies", "price": "100 INR"})
+    await db["plans"].insert_one({
+        "_id": "p1", "category": "movie", "label": "1 Month", "days": 30, "price": "100 INR"
+    })
+    order = {
+        "_id": ObjectId(), "ref": "AB12CD34", "user_id": 7, "user_name": "U",
+        "category": "movie", "plan_id": "p1", "proof": {"kind": "text"},
+        "status": "pending", "created_at": datetime.utcnow(), **extra
+    }
+    await db["orders"].insert_one(order)
+    return order
+
+
+@pytest.fixture
+def granted(monkeypatch):
+    # extend_subscription's pipeline needs a real server; record the calls
+    calls = []
+
+    async def save(uid, cat, plan_id, days, key):
+        calls.append(key)
+        return {"user_id": uid, "category": cat, "expires_at": datetime.utcnow() + timedelta(days=days)}
+
+    monkeypatch.setattr(bot, "save_approved_subscription", save)
+    return calls
+
+
+def test_claim_order_once_until_the_claim_lapses(db):
+    async def scenario():
+        order = await seed_order(db)
+        first = await bot.claim_order(order["_id"], 1)
+        second = await bot.claim_order(order["_id"], 2)
+        await db["orders"].update_one({"_id": order["_id"]}, {"$set": {
+            "claimed_at": datetime.utcnow() - timedelta(seconds=bot.ORDER_CLAIM_TIMEOUT + 1)
+        }})
+        third = await bot.claim_order(order["_id"], 2)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first["reviewed_by"] == 1
+    assert second is None
+    assert third["reviewed_by"] == 2
+
+
+def test_approve_twice_grants_once(db, fake_bot, granted):
+    async def scenario():
+        order = await seed_order(db)
+        results = await asyncio.gather(
+            bot.approve_order(order["_id"], 1), bot.approve_order(order["_id"], 2)
+        )
+        return results, await db["orders"].find_one({"_id": order["_id"]})
+
+    results, order = asyncio.run(scenario())
+    assert sum(r is not None for r in results) == 1
+    assert granted == [str(order["_id"])]
+    assert order["status"] == "approved"
+    assert [c[1][0] for c in fake_bot.called("send_message")] == [7]
+
+
+def test_failed_subscription_write_returns_order_to_queue(db, fake_bot, monkeypatch):
+    async def broken(*args):
+        raise RuntimeError("mongo down")
+    monkeypatch.setattr(bot, "save_approved_subscription", broken)
+
+    async def scenario():
+        order = await seed_order(db)
+        with pytest.raises(RuntimeError):
+            await bot.approve_order(order["_id"], 1)
+        return await db["orders"].find_one({"_id": order["_id"]})
+
+    assert asyncio.run(scenario())["status"] == "pending"
+
+
+def test_failed_invite_links_keep_the_order_out_of_the_queue(db, fake_bot, granted, monkeypatch):
+    failures = [RuntimeError("flood wait")]
+
+    async def links(category):
+        if failures:
+            raise failures.pop()
+        return []
+    monkeypatch.setattr(bot, "create_invite_links", links)
+
+    async def scenario():
+        order = await seed_order(db)
+        with pytest.raises(RuntimeError):
+            await bot.approve_order(order["_id"], 1)
+        after_failure = await db["orders"].find_one({"_id": order["_id"]})
+        rejected = await bot.reject_order(order["_id"], 1)
+        retried = await bot.approve_order(order["_id"], 2)
+        return after_failure, rejected, retried
+
+    after_failure, rejected, retried = asyncio.run(scenario())
+    # the subscription was granted: not pending, not rejectable, but a
+    # second tap can claim it straight away to retry the links
+    assert after_failure["status"] == "approving"
+    assert rejected is None
+    assert retried is not None
+    # both attempts pass the same approval key, extend_subscription skips
+    # the second one
+    assert len(set(granted)) == 1
+
+
+def test_extend_skips_an_approval_key_already_applied(db):
+    async def scenario():
+        sub = {
+            "_id": 1, "user_id": 7, "category": "movie", "status": "active",
+            "expires_at": datetime(2030, 1, 1), "approval_key": "later-order"
+        }
+        await db["subscriptions"].insert_one(sub)
+        await db["approvals"].insert_one({"_id": "first-order"})
+        return await bot.extend_subscription(7, "movie", "p1", 30, "first-order")
+
+    sub = asyncio.run(scenario())
+    assert sub["expires_at"] == datetime(2030, 1, 1)
+
+
+def test_approval_applied_checks_history():
+    sub = {"approval_key": "b", "history": [{"approval_key": "a"}]}
+    assert bot.approval_applied(sub, "a")
+    assert bot.approval_applied(sub, "b")
+    assert not bot.approval_applied(sub, "c")
+    assert not bot.approval_applied(None, "a")
@@ -0,0 +1,87 @@
+import asyncio
+import io
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def approved(monkeypatch):
+    ids = []
+
+    async def approve(order_id, admin_id):
+        ids.append(order_id)
+        return {"_id": order_id}
+
+    monkeypatch.setattr(bot, "approve_order", approve)
+    return ids
+
+
+def order(_id, ref, amount, tagged=False, price="199 INR"):
+    return {
+        "_id": _id, "ref": ref, "amount": amount, "amount_tagged": tagged,
+        "price": price, "status": "pending", "created_at": datetime.utcnow()
+    }
+
+
+def reconcile(db, orders, rows, header="Date,Narration,Credit"):
+    async def scenario():
+        await db["orders"].insert_many(orders)
+        statement = "\n".join([header] + rows) + "\n"
+        return await bot.reconcile_file(io.BytesIO(statement.encode()), 9)
+    return asyncio.run(scenario())
+
+
+TODAY = datetime.utcnow().strftime("%d/%m/%Y")
+
+
+def test_reference_match_approves(db, approved):
+    report = reconcile(db, [order(1, "AB12CD34", "199.00")], [f"{TODAY},UPI/AB12CD34/x,199.00"])
+    assert approved == [1]
+    assert report["approved"] == 1
+
+
+def test_reference_with_untagged_price_approves_tagged_order(db, approved):
+    report = reconcile(db, [order(1, "AB12CD34", "199.37", tagged=True)], [f"{TODAY},UPI AB12CD34,199.00"])
+    assert approved == [1]
+    assert report["approved"] == 1
+
+
+def test_reference_with_wrong_amount_does_not_approve(db, approved):
+    report = reconcile(db, [order(1, "AB12CD34", "199.00")], [f"{TODAY},UPI AB12CD34,19.00"])
+    assert approved == []
+    assert report["unmatched"] == 1
+
+
+def test_tagged_amount_is_only_suggested(db, approved):
+    report = reconcile(db, [order(1, "AB12CD34", "199.37", tagged=True)], [f"{TODAY},UPI payment,199.37"])
+    assert approved == []
+    assert report["amount_only"] == 1
+    assert [s["ref"] for s in report["suggested"]] == ["AB12CD34"]
+
+
+def test_ambiguous_amount_is_counted_not_suggested(db, approved):
+    orders = [order(1, "AB12CD34", "199.37", tagged=True), order(2, "EF56AB78", "199.37", tagged=True)]
+    report = reconcile(db, orders, [f"{TODAY},UPI payment,199.37"])
+    assert approved == []
+    assert report["amount_only"] == 1
+    assert report["suggested"] == []
+
+
+def test_undated_row_needs_a_reference(db, approved):
+    orders = [order(1, "AB12CD34", "199.37", tagged=True), order(2, "EF56AB78", "99.00")]
+    report = reconcile(db, orders, ["UPI payment,199.37", "UPI EF56AB78,99.00"], header="Narration,Credit")
+    assert approved == [2]
+    assert report["unmatched"] == 1
+    assert report["suggested"] == []
+
+
+def test_debits_are_ignored(db, approved):
+    report = reconcile(
+        db, [order(1, "AB12CD34", "199.00")],
+        [f"{TODAY},UPI AB12CD34,199.00,DR"], header="Date,Narration,Amount,Type"
+    )
+    assert approved == []
+    assert report["credits"] == 0
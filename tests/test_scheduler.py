@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import bot
+
+
+async def add_sub(db, _id, expires_in, status="active", **extra):
+    sub = {
+        "_id": _id,
+        "user_id": 100 + _id,
+        "category": "movie",
+        "status": status,
+        "expires_at": datetime.utcnow() + expires_in,
+        **extra
+    }
+    await db["subscriptions"].insert_one(sub)
+    return sub
+
+
+async def add_job(db, sub_id, kind="expiry", run_in=timedelta(seconds=-1)):
+    await db["jobs"].insert_one({
+        "_id": f"{kind}:{sub_id}",
+        "kind": kind,
+        "sub_id": sub_id,
+        "run_at": datetime.utcnow() + run_in,
+        "status": "pending",
+        "attempts": 0,
+        "locked_by": None,
+        "locked_until": None
+    })
+
+
+def kicked(fake_bot):
+    return [c[1][0] for c in fake_bot.called("send_message")]
+
+
+def test_claim_jobs_claims_each_due_job_once(db):
+    async def scenario():
+        await add_job(db, 1)
+        await add_job(db, 2, run_in=timedelta(hours=1))
+        now = datetime.utcnow()
+        first = await bot.claim_jobs(["expiry:1", "expiry:2"], now)
+        second = await bot.claim_jobs(["expiry:1", "expiry:2"], now)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert [j["_id"] for j in first] == ["expiry:1"]
+    assert first[0]["status"] == "running" and first[0]["attempts"] == 1
+    assert second == []
+
+
+def test_expiry_pass_kicks_due_and_skips_renewed(db, fake_bot):
+    async def scenario():
+        await add_sub(db, 1, timedelta(minutes=-1))
+        await add_sub(db, 2, timedelta(days=3))  # renewed after the job was scheduled
+        await add_job(db, 1)
+        await add_job(db, 2)
+        jobs = await bot.claim_jobs(["expiry:1", "expiry:2"], datetime.utcnow())
+        failed = await bot.run_job_batch(jobs)
+        await bot.jobs_writes.flush()
+        subs = {s["_id"]: s async for s in db["subscriptions"].find()}
+        jobs = {j["_id"]: j async for j in db["jobs"].find()}
+        return failed, subs, jobs
+
+    failed, subs, jobs = asyncio.run(scenario())
+    assert failed == 0
+    assert kicked(fake_bot) == [101]
+    assert subs[1]["status"] == "expired" and subs[2]["status"] == "active"
+    assert jobs["expiry:1"]["status"] == "done"
+    # pushed back to the new expiry instead of finishing
+    assert jobs["expiry:2"]["status"] == "pending"
+    assert jobs["expiry:2"]["run_at"] == subs[2]["expires_at"]
+
+
+def test_renewal_during_pass_is_not_kicked(db, fake_bot):
+    async def scenario():
+        await add_sub(db, 1, timedelta(minutes=-1))
+        await add_job(db, 1)
+        jobs = await bot.claim_jobs(["expiry:1"], datetime.utcnow())
+        await bot.expire_due_subscriptions(jobs, datetime.utcnow())
+        snapshot = await db["subscriptions"].find_one({"_id": 1})
+
+        # the user pays while the pass is still sending other kicks; even a
+        # renewal that left expired_by behind must win
+        await db["subscriptions"].update_one({"_id": 1}, {"$set": {
+            "status": "active", "expires_at": datetime.utcnow() + timedelta(days=30)
+        }})
+        return await bot.run_expiry_job(jobs[0], snapshot)
+
+    asyncio.run(scenario())
+    assert kicked(fake_bot) == []
+    assert fake_bot.called("ban_chat_member") == []
+
+
+def test_retry_kicks_again_after_failed_kick(db, fake_bot):
+    async def scenario():
+        # an earlier pass expired it with its own token, then the kick failed
+        await add_sub(db, 1, timedelta(minutes=-5), status="expired", expired_by="old-pass")
+        await add_job(db, 1)
+        await db["jobs"].update_one({"_id": "expiry:1"}, {"$set": {"attempts": 1}})
+        jobs = await bot.claim_jobs(["expiry:1"], datetime.utcnow())
+        return await bot.run_job_batch(jobs)
+
+    assert asyncio.run(scenario()) == 0
+    assert kicked(fake_bot) == [101]
+
+
+def test_first_attempt_leaves_other_pass_kick_alone(db, fake_bot):
+    async def scenario():
+        # another process expired it in the same moment and kicks the user
+        await add_sub(db, 1, timedelta(minutes=-1), status="expired", expired_by="other-pass")
+        await add_job(db, 1)
+        jobs = await bot.claim_jobs(["expiry:1"], datetime.utcnow())
+        return await bot.run_job_batch(jobs)
+
+    assert asyncio.run(scenario()) == 0
+    assert kicked(fake_bot) == []
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime
+
+from aiogram import Dispatcher, Router, types
+from aiogram.filters import StateFilter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import bot
+
+
+def key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_one_users_updates_run_in_arrival_order():
+    ordering = bot.UpdateOrdering(0)
+    log = []
+
+    async def update(user_id, name, delay):
+        async with ordering.lock(key(user_id)):
+            log.append(f"{name}+")
+            await asyncio.sleep(delay)
+            log.append(f"{name}-")
+
+    async def scenario():
+        await asyncio.gather(update(5, "a", 0.03), update(5, "b", 0), update(6, "c", 0))
+
+    asyncio.run(scenario())
+    # b waits for a, the other user's c does not
+    assert log.index("b+") > log.index("a-")
+    assert log.index("c-") < log.index("a-")
+    assert ordering.keys == {}
+
+
+def test_global_cap_limits_concurrent_updates():
+    ordering = bot.UpdateOrdering(2)
+    running, peak = 0, 0
+
+    async def update(user_id):
+        nonlocal running, peak
+        async with ordering.lock(key(user_id)):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    async def scenario():
+        await asyncio.gather(*(update(u) for u in range(6)))
+
+    asyncio.run(scenario())
+    assert peak == 2
+    assert ordering.stats == {"active": 0, "waiting": 0, "max_depth": 1}
+
+
+def test_proof_right_after_payment_sees_the_new_state():
+    # the state is read under the user's lock: the proof message must reach
+    # the waiting_for_proof handler even though it arrives mid-callback
+    got = []
+    router = Router()
+
+    @router.callback_query()
+    async def proceed(c, state):
+        await asyncio.sleep(0.05)
+        await state.set_state(bot.UserState.waiting_for_proof)
+
+    @router.message(StateFilter(bot.UserState.waiting_for_proof))
+    async def proof(m, state):
+        got.append(m.text)
+
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=bot.UpdateOrdering(0))
+    dp.include_router(router)
+
+    user = {"id": 5, "is_bot": False, "first_name": "U"}
+    message = {
+        "message_id": 1, "date": int(datetime.now().timestamp()),
+        "chat": {"id": 5, "type": "private"}, "from": user, "text": "paid"
+    }
+    callback = types.Update(update_id=1, callback_query={
+        "id": "1", "from": user, "chat_instance": "c", "data": "pay_now", "message": message
+    })
+    proof_message = types.Update(update_id=2, message=message)
+
+    async def scenario():
+        async def later():
+            await asyncio.sleep(0.01)
+            await dp.feed_update(bot.bot, proof_message)
+        await asyncio.gather(dp.feed_update(bot.bot, callback), later())
+
+    asyncio.run(scenario())
+    assert got == ["paid"]